@@ -0,0 +1,231 @@
+#!/usr/bin/env nix-shell
+#!nix-shell -p "python3.withPackages (p: with p; [ ])" -i python3
+"""Benchmarks for sync-with-nixpkgs.py on synthetic corepkgs/nixpkgs trees"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager, redirect_stderr
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Iterator, Optional
+
+scripts_dir = Path(__file__).parent.resolve()
+
+import importlib.util
+spec = importlib.util.spec_from_file_location("sync_with_nixpkgs", scripts_dir / "sync-with-nixpkgs.py")
+sync_with_nixpkgs = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(sync_with_nixpkgs)
+
+# Number of top-level corepkgs directories; all of them are monitored for new files
+GROUPS = 8
+FILES_PER_DIR = 50
+
+
+@dataclass
+class Scenario:
+    files: int
+    diff_ratio: float = 0.1
+    new_ratio: float = 0.01
+    mapping_depth: int = 1
+    seed: int = 0
+
+    @property
+    def name(self) -> str:
+        return f"files={self.files},diff={self.diff_ratio},new={self.new_ratio},depth={self.mapping_depth}"
+
+
+@dataclass
+class PhaseResult:
+    seconds: float
+    # read()/write() calls as counted in /proc/self/io; stat, open and getdents are not included
+    read_calls: Optional[int]
+    write_calls: Optional[int]
+    bytes_read: Optional[int]
+    # Peak of the Python allocations made during the phase, only traced with --trace-memory
+    peak_alloc_kib: Optional[int]
+
+
+def file_content(index: int, variant: str = "") -> str:
+    """Return a small nix expression for a synthetic file."""
+    lines = [f"{{ lib, stdenv, fetchurl }}:", "", "stdenv.mkDerivation {", f'  pname = "pkg-{index}";']
+    lines += [f'  # line {n}{variant}' if n == 7 else f"  # line {n}" for n in range(16)]
+    return "\n".join(lines + ["}", ""])
+
+
+def generate_trees(root: Path, scenario: Scenario) -> tuple[Path, Path, dict[str, str]]:
+    """Generate corepkgs and nixpkgs trees for a scenario.
+
+    Files are spread over GROUPS top-level directories of FILES_PER_DIR files each.
+    Every file sits below mapping_depth nested PATH_MAPPINGS entries, which all
+    place it below pkgs/ in nixpkgs; the deepest one is used for the lookup.
+
+    Returns:
+        tuple: (corepkgs, nixpkgs, path_mappings)
+    """
+    rng = random.Random(scenario.seed)
+    corepkgs, nixpkgs = root / "corepkgs", root / "nixpkgs"
+    levels = [f"l{k}" for k in range(1, scenario.mapping_depth)]
+    mappings = {}
+    for group in range(GROUPS):
+        for depth in range(scenario.mapping_depth):
+            prefix = "/".join([f"g{group}"] + levels[:depth])
+            mappings[prefix] = f"pkgs/{prefix}"
+
+    def write(path: Path, content: str) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+
+    for index in range(scenario.files):
+        dir_index = index // FILES_PER_DIR
+        rel_dir = "/".join([f"g{dir_index % GROUPS}"] + levels + [f"d{dir_index}"])
+        write(corepkgs / rel_dir / f"f{index}.nix", file_content(index))
+        variant = " changed" if rng.random() < scenario.diff_ratio else ""
+        write(nixpkgs / "pkgs" / rel_dir / f"f{index}.nix", file_content(index, variant))
+        if rng.random() < scenario.new_ratio:
+            write(nixpkgs / "pkgs" / rel_dir / f"n{index}.nix", file_content(index))
+    return corepkgs, nixpkgs, mappings
+
+
+@contextmanager
+def measure(results: dict[str, PhaseResult], phase: str, trace_memory: bool = False) -> Iterator[None]:
+    """Time a phase and record its read/write call counts and, with trace_memory, its peak allocations."""
+    if trace_memory:
+        tracemalloc.start()
+    io_before = sync_with_nixpkgs.process_io_counters()
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, redirect_stderr(devnull):
+        yield
+    seconds = time.perf_counter() - start
+    peak_alloc_kib = None
+    if trace_memory:
+        peak_alloc_kib = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    io_after = sync_with_nixpkgs.process_io_counters()
+    delta = {k: io_after[k] - io_before[k] for k in io_after if k in io_before}
+    results[phase] = PhaseResult(
+        seconds=seconds,
+        read_calls=delta.get("syscr"),
+        write_calls=delta.get("syscw"),
+        bytes_read=delta.get("rchar"),
+        peak_alloc_kib=peak_alloc_kib,
+    )
+
+
+@contextmanager
+def synthetic_config(mappings: dict[str, str]) -> Iterator[None]:
+    """Point the sync tool configuration at the synthetic trees."""
+    names = ["PATH_MAPPINGS", "CHECK_NEW_FILES", "CHECK_NEW_FILES_IGNORE_NEW_DIRS"]
+    originals = {name: getattr(sync_with_nixpkgs, name) for name in names}
+    sync_with_nixpkgs.PATH_MAPPINGS = mappings
+    sync_with_nixpkgs.CHECK_NEW_FILES = [f"g{group}" for group in range(GROUPS)]
+    sync_with_nixpkgs.CHECK_NEW_FILES_IGNORE_NEW_DIRS = []
+    # The mapping tries are compiled once, so they are rebuilt for every PATH_MAPPINGS swap
+    sync_with_nixpkgs._compiled_mappings = None
+    try:
+        yield
+    finally:
+        for name, value in originals.items():
+            setattr(sync_with_nixpkgs, name, value)
+        sync_with_nixpkgs._compiled_mappings = None
+
+
+def run_scenario(
+    scenario: Scenario, jobs: int = 1, diff_backend: str = "diff", trace_memory: bool = False
+) -> dict[str, PhaseResult]:
+    """Run process_files, check_new_files and patch generation on a fresh synthetic tree.
+
+    process_files is measured end to end; check_new_files and patch generation are
+    then measured again on their own against the same trees.
+    """
+    results: dict[str, PhaseResult] = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        corepkgs, nixpkgs, mappings = generate_trees(Path(tmpdir), scenario)
+        with synthetic_config(mappings):
+            patches_dir = Path(tmpdir) / "patches"
+            patches_dir.mkdir()
+            stats = sync_with_nixpkgs.DiffStats()
+            with measure(results, "process_files", trace_memory):
+                sync_with_nixpkgs.process_files(
+                    corepkgs, nixpkgs, patches_dir, stats, jobs=jobs, diff_backend=diff_backend
+                )
+
+            with measure(results, "check_new_files", trace_memory):
+                sync_with_nixpkgs.check_new_files(corepkgs, nixpkgs, sync_with_nixpkgs.DiffStats(), jobs=jobs)
+
+            shutil.rmtree(patches_dir)
+            patches_dir.mkdir()
+            with measure(results, "patch_generation", trace_memory):
+                for dir_path, files_in_dir in sorted(stats.directories_with_diffs.items()):
+                    sync_with_nixpkgs.generate_directory_patch(
+                        dir_path, files_in_dir, corepkgs, nixpkgs, patches_dir, diff_backend
+                    )
+    return results
+
+
+def compare_with_baseline(
+    name: str, results: dict[str, PhaseResult], baseline: dict, tolerance: float
+) -> list[str]:
+    """List the phases that got slower than tolerance times their baseline."""
+    regressions = []
+    for phase, result in results.items():
+        if (previous := baseline.get(name, {}).get(phase)) and result.seconds > previous["seconds"] * tolerance + 0.05:
+            regressions.append(f"{name} {phase}: {result.seconds:.3f}s (baseline {previous['seconds']:.3f}s)")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark sync-with-nixpkgs.py on synthetic corepkgs/nixpkgs trees",
+        epilog="Examples:\n  %(prog)s --files 1000 10000\n  %(prog)s --files 200000 --diff-ratio 0.02 --baseline baseline.json",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--files", type=int, nargs="+", default=[1000], help="Tree sizes to benchmark (default: 1000)")
+    parser.add_argument("--diff-ratio", type=float, default=0.1, help="Fraction of files that differ (default: 0.1)")
+    parser.add_argument("--new-ratio", type=float, default=0.01, help="Fraction of files that get a new sibling in nixpkgs (default: 0.01)")
+    parser.add_argument("--mapping-depth", type=int, default=1, help="Nested PATH_MAPPINGS entries along each file path (default: 1)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Worker threads passed to the sync tool (default: 1)")
+    parser.add_argument("--diff-backend", choices=sync_with_nixpkgs.DIFF_BACKENDS, default="diff")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per scenario; the fastest run is kept (default: 1)")
+    parser.add_argument("--baseline", type=Path, help="JSON file with baseline results to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results in the --baseline file")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="Allowed slowdown factor over the baseline (default: 1.25)")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Record the peak Python allocations of each phase with tracemalloc; slows down the phases")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON instead of a table")
+    args = parser.parse_args()
+
+    baseline = json.loads(args.baseline.read_text()) if args.baseline and args.baseline.exists() else {}
+    report, regressions = {}, []
+    for files in args.files:
+        scenario = Scenario(files, args.diff_ratio, args.new_ratio, args.mapping_depth)
+        runs = [run_scenario(scenario, args.jobs, args.diff_backend, args.trace_memory) for _ in range(max(args.repeat, 1))]
+        results = {phase: min((run[phase] for run in runs), key=lambda r: r.seconds) for phase in runs[0]}
+        report[scenario.name] = {phase: asdict(result) for phase, result in results.items()}
+        regressions += compare_with_baseline(scenario.name, results, baseline, args.tolerance)
+        if not args.json:
+            print(scenario.name)
+            for phase, result in results.items():
+                memory = f"  peak allocated: {result.peak_alloc_kib} KiB" if result.peak_alloc_kib is not None else ""
+                print(f"  {phase:<18} {result.seconds:8.3f}s  read() calls: {result.read_calls}  "
+                      f"write() calls: {result.write_calls}{memory}")
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    if args.baseline and args.save_baseline:
+        args.baseline.write_text(json.dumps({**baseline, **report}, indent=2) + "\n")
+    if regressions:
+        print("\nRegressions against baseline:", file=sys.stderr)
+        for regression in regressions:
+            print(f"  {regression}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,24 @@
 """Generate per-file patches between corepkgs and nixpkgs, handling directory structure differences."""
 
 import argparse
+import cProfile
+import difflib
+import hashlib
+import json
+import os
+import re
+import resource
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass, field
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Iterable, Iterator, Optional
 
 CHECK_NEW_FILES = [
     "build-support",
@@ -54,6 +66,10 @@ IGNORE_FILES = [
 
 PATCHES_DIR = "patches"
 
+STATE_FILE = ".sync-state.json"
+
+DIFF_BACKENDS = ["diff", "python"]
+
 PATH_MAPPINGS = {
     "build-support": "pkgs/build-support",
     "common-updater": "pkgs/common-updater",
@@ -107,12 +123,542 @@ class DiffStats:
     new_files_list: list[str] = field(default_factory=list)
     # Track directories with differences for patch generation
     directories_with_diffs: dict[str, list[tuple[str, Path, Path]]] = field(default_factory=dict)
+    # Called with (status, rel_path, nixpkgs_file) for every recorded decision
+    listeners: list[Callable[[str, str, Optional[Path]], None]] = field(default_factory=list)
+    # Without lists only the counters grow; decisions are then expected to be consumed by listeners
+    keep_lists: bool = True
+
+    def record(self, status: str, rel_path: str, file_path: Optional[Path] = None, nixpkgs_file: Optional[Path] = None) -> None:
+        """Count one per-file decision and pass it on to the listeners.
+        
+        status is one of "ignored", "identical", "different", "not_found" or "new".
+        """
+        if status == "ignored":
+            self.ignored += 1
+        elif status == "new":
+            self.new_files += 1
+            if self.keep_lists:
+                self.new_files_list.append(rel_path)
+        else:
+            self.processed += 1
+            if status == "not_found":
+                self.not_found += 1
+                if self.keep_lists:
+                    self.not_found_list.append(rel_path)
+            else:
+                self.found += 1
+                if status == "different":
+                    self.different += 1
+        if status in ("different", "new"):
+            self.directories_with_diffs.setdefault(get_directory_path(rel_path), []).append((rel_path, file_path, nixpkgs_file))
+        for listener in self.listeners:
+            listener(status, rel_path, nixpkgs_file)
+
+
+@dataclass
+class PrefixTrie:
+    """Path-component trie of mapping prefixes, answering longest-prefix-match queries."""
+    children: dict[str, "PrefixTrie"] = field(default_factory=dict)
+    entries: list[tuple[str, str]] = field(default_factory=list)
+
+    def insert(self, prefix: str, entry: tuple[str, str]) -> None:
+        node = self
+        for part in prefix.split("/"):
+            node = node.children.setdefault(part, PrefixTrie())
+        node.entries.append(entry)
+
+    def matches(self, path: str) -> list[tuple[str, str]]:
+        """Return the entries of all prefixes of path, longest prefix first."""
+        found, node = [], self
+        for part in path.split("/"):
+            if (node := node.children.get(part)) is None:
+                break
+            found.append(node.entries)
+        return [entry for entries in reversed(found) for entry in entries]
+
+
+# Compiled on first use; PATH_MAPPINGS is constant while the script runs, code
+# changing it (the tests) must reset this to None.
+_compiled_mappings: Optional[tuple[PrefixTrie, PrefixTrie]] = None
+
+
+def mapping_tries() -> tuple[PrefixTrie, PrefixTrie]:
+    """Return (corepkgs -> nixpkgs, nixpkgs -> corepkgs) tries for PATH_MAPPINGS."""
+    global _compiled_mappings
+    if _compiled_mappings is None:
+        forward, reverse = PrefixTrie(), PrefixTrie()
+        for core_prefix, nix_prefix in PATH_MAPPINGS.items():
+            forward.insert(core_prefix, (core_prefix, nix_prefix))
+            reverse.insert(nix_prefix, (core_prefix, nix_prefix))
+        _compiled_mappings = (forward, reverse)
+    return _compiled_mappings
+
+
+class TreeSnapshot:
+    """In-memory view of a directory tree, listing each directory at most once with os.scandir.
+
+    Existence and type queries for paths under root are answered from the cached
+    listings; paths outside root fall back to the filesystem.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self._prefix = f"{root}/"
+        # rel_dir -> {name: kind}, kind is "d" (directory), "l" (symlink to directory), "f" (file) or "o" (other)
+        self._listings: dict[str, dict[str, str]] = {}
+
+    def listing(self, rel_dir: str) -> dict[str, str]:
+        """Return {name: kind} for a directory relative to root, empty if it is not a directory."""
+        if (entries := self._listings.get(rel_dir)) is None:
+            entries = {}
+            if not rel_dir or self.kind(rel_dir) in ("d", "l"):
+                try:
+                    with os.scandir(f"{self._prefix}{rel_dir}" if rel_dir else self.root) as it:
+                        for entry in it:
+                            is_dir = entry.is_dir()
+                            entries[entry.name] = ("l" if entry.is_symlink() else "d") if is_dir else "f" if entry.is_file() else "o"
+                except OSError:
+                    pass
+            self._listings[rel_dir] = entries
+        return entries
+
+    def kind(self, rel_path: str) -> Optional[str]:
+        """Return the kind of a path relative to root, or None if it does not exist."""
+        if not rel_path:
+            return "d"
+        parent, _, name = rel_path.rpartition("/")
+        return self.listing(parent).get(name)
+
+    def _rel(self, path: Path) -> Optional[str]:
+        path_str = str(path)
+        if path_str == str(self.root):
+            return ""
+        return path_str[len(self._prefix):] if path_str.startswith(self._prefix) else None
+
+    def is_file(self, path: Path) -> bool:
+        return path.is_file() if (rel := self._rel(path)) is None else self.kind(rel) == "f"
+
+    def is_dir(self, path: Path) -> bool:
+        return path.is_dir() if (rel := self._rel(path)) is None else self.kind(rel) in ("d", "l")
+
+    def exists(self, path: Path) -> bool:
+        return path.exists() if (rel := self._rel(path)) is None else self.kind(rel) is not None
+
+    def iterdir(self, path: Path) -> list[Path]:
+        if (rel := self._rel(path)) is None:
+            return list(path.iterdir())
+        return [path / name for name in self.listing(rel)]
+
+    def walk(self, rel_dir: str = "") -> Iterator[str]:
+        """Yield paths of all files below a directory, without following directory symlinks or entering .git."""
+        for name, kind in self.listing(rel_dir).items():
+            rel_path = f"{rel_dir}/{name}" if rel_dir else name
+            if name == ".git":
+                continue
+            if kind == "f":
+                yield rel_path
+            elif kind == "d":
+                yield from self.walk(rel_path)
+
+
+@dataclass
+class DigestCache:
+    """Persistent per-file content digests, invalidated when a file's stat data changes.
+
+    Entries are keyed by absolute path and store [size, mtime_ns, inode, sha256].
+    Files below one of the transient roots (e.g. temporary worktrees) are hashed
+    without being cached, as their paths and inodes change with every run.
+    """
+    path: Path
+    entries: dict[str, list] = field(default_factory=dict)
+    dirty: bool = False
+    transient: tuple[str, ...] = ()
+    # Keys looked up in this run; the others are dropped on save
+    used: set[str] = field(default_factory=set)
+
+    VERSION = 1
+
+    @classmethod
+    def load(cls, path: Path) -> "DigestCache":
+        """Load a cache file, starting empty if it is missing, unreadable or from another version."""
+        try:
+            data = json.loads(path.read_text())
+        except (OSError, ValueError):
+            data = {}
+        entries = data.get("entries") if isinstance(data, dict) and data.get("version") == cls.VERSION else None
+        return cls(path, entries if isinstance(entries, dict) else {})
+
+    def digest(self, file: Path, st: os.stat_result) -> str:
+        """Return the digest of a file, reading it only if its stat data changed since it was cached."""
+        key = str(file)
+        if self.transient and key.startswith(self.transient):
+            with open(file, "rb") as f:
+                return hashlib.file_digest(f, "sha256").hexdigest()
+        self.used.add(key)
+        stamp = [st.st_size, st.st_mtime_ns, st.st_ino]
+        entry = self.entries.get(key)
+        if entry and entry[:3] == stamp:
+            return entry[3]
+        with open(file, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+        self.entries[key] = stamp + [digest]
+        self.dirty = True
+        return digest
+
+    def save(self, prune: bool = True) -> None:
+        """Write the cache back to disk if it changed.
+
+        With prune, entries for files that were not looked up since loading are dropped.
+        """
+        if prune and len(self.used) < len(self.entries):
+            self.entries = {key: entry for key, entry in self.entries.items() if key in self.used}
+            self.dirty = True
+        if not self.dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps({"version": self.VERSION, "entries": self.entries}))
+        tmp.replace(self.path)
+        self.dirty = False
+
+
+@dataclass
+class GitIndex:
+    """Blob SHAs of the tracked files in both trees, keyed by path relative to each root.
+
+    The *_trees maps hold the git tree SHAs of directories whose working tree matches HEAD exactly.
+    """
+    corepkgs: dict[str, str]
+    nixpkgs: dict[str, str]
+    corepkgs_trees: dict[str, str] = field(default_factory=dict)
+    nixpkgs_trees: dict[str, str] = field(default_factory=dict)
+
+    def identical(self, rel_path: str, nixpkgs_rel_path: str) -> Optional[bool]:
+        """Compare two files by blob SHA, or return None if either is not known to the index."""
+        core_sha, nix_sha = self.corepkgs.get(rel_path), self.nixpkgs.get(nixpkgs_rel_path)
+        return None if core_sha is None or nix_sha is None else core_sha == nix_sha
+
+    def same_tree(self, rel_dir: str, nixpkgs_rel_dir: str) -> bool:
+        """Check whether two clean directories have the same git tree, i.e. identical contents."""
+        core_sha = self.corepkgs_trees.get(rel_dir)
+        return core_sha is not None and core_sha == self.nixpkgs_trees.get(nixpkgs_rel_dir)
+
+
+def git_blob_index(repo: Path) -> Optional[dict[str, str]]:
+    """Read blob SHAs for all regular files in the git index of repo.
+
+    Files with unstaged changes, symlinks, submodules and unmerged entries are
+    left out so that they fall back to a content comparison.
+    Returns None if repo is not inside a git work tree.
+    """
+    result = subprocess.run(["git", "-C", str(repo), "ls-files", "--stage", "-z"], capture_output=True)
+    if result.returncode != 0:
+        return None
+    blobs = {}
+    for entry in result.stdout.split(b"\0"):
+        if not entry:
+            continue
+        meta, _, path = entry.partition(b"\t")
+        mode, sha, stage = meta.split(b" ")
+        if mode in (b"100644", b"100755") and stage == b"0":
+            blobs[os.fsdecode(path)] = sha.decode()
+    modified = subprocess.run(["git", "-C", str(repo), "ls-files", "--modified", "-z"], capture_output=True)
+    for path in modified.stdout.split(b"\0"):
+        blobs.pop(os.fsdecode(path), None)
+    return blobs
+
+
+def git_tree_index(repo: Path) -> Optional[dict[str, str]]:
+    """Read the git tree SHAs of all directories of HEAD in repo.
+
+    Directories containing changes against HEAD or untracked (including ignored)
+    files are left out, so a tree SHA always describes the directory on disk.
+    Returns None if repo is not a git checkout with a HEAD commit.
+    """
+    result = subprocess.run(["git", "-C", str(repo), "ls-tree", "-r", "-t", "-z", "HEAD"], capture_output=True)
+    if result.returncode != 0:
+        return None
+    trees = {}
+    for entry in result.stdout.split(b"\0"):
+        meta, _, path = entry.partition(b"\t")
+        if meta.split(b" ")[1:2] == [b"tree"]:
+            trees[os.fsdecode(path)] = meta.split(b" ")[2].decode()
+    for cmd in (["diff", "HEAD", "--name-only", "--no-renames", "--relative", "-z"], ["ls-files", "--others", "-z"]):
+        result = subprocess.run(["git", "-C", str(repo), *cmd], capture_output=True)
+        if result.returncode != 0:
+            return None
+        for path in result.stdout.split(b"\0"):
+            dir_path = os.fsdecode(path).rstrip("/")
+            while dir_path:
+                trees.pop(dir_path, None)
+                dir_path = dir_path.rpartition("/")[0]
+    return trees
+
+
+def load_git_index(
+    corepkgs: Path,
+    nixpkgs: Path,
+    corepkgs_blobs: Optional[dict[str, str]] = None,
+    corepkgs_trees: Optional[dict[str, str]] = None,
+) -> Optional[GitIndex]:
+    """Load blob SHAs (and clean tree SHAs where available) for both trees, or return None if either is not a git checkout.
+
+    The corepkgs SHAs can be passed in when they were already read for another nixpkgs tree.
+    """
+    corepkgs_blobs = git_blob_index(corepkgs) if corepkgs_blobs is None else corepkgs_blobs
+    nixpkgs_blobs = git_blob_index(nixpkgs)
+    if corepkgs_blobs is None or nixpkgs_blobs is None:
+        return None
+    if corepkgs_trees is None:
+        corepkgs_trees = git_tree_index(corepkgs) or {}
+    return GitIndex(corepkgs_blobs, nixpkgs_blobs, corepkgs_trees, git_tree_index(nixpkgs) or {})
+
+
+def identical_subtrees(git_index: GitIndex, nix_tree: TreeSnapshot) -> dict[str, str]:
+    """Find the corepkgs directories whose files all map into one nixpkgs directory with the same git tree.
+
+    Every file below such a directory is identical to its counterpart, so its
+    mapping and comparison can be skipped.
+
+    Returns:
+        dict: corepkgs directory -> nixpkgs directory, both relative to their roots
+    """
+    forward = mapping_tries()[0]
+    # Directories containing a more specific mapping, which would send some of their files elsewhere
+    mapping_parents = {core_prefix.rsplit("/", i)[0] for core_prefix in PATH_MAPPINGS for i in range(1, core_prefix.count("/") + 1)}
+    subtrees = {}
+    for dir_path in git_index.corepkgs_trees:
+        if (kind := nix_tree.kind(dir_path)) is not None:
+            # map_path prefers the exact path, so the directory has to match itself
+            if kind != "d":
+                continue
+            nix_dir = dir_path
+        elif dir_path in mapping_parents or dir_path == "pkgs" or (dir_path.startswith("pkgs/") and dir_path.count("/") == 1):
+            # pkgs/<name>/default.nix may be redirected to pkgs/by-name
+            continue
+        elif matches := forward.matches(dir_path):
+            core_prefix, nix_prefix = matches[0]
+            nix_dir = f"{nix_prefix}/{dir_path[len(core_prefix):].lstrip('/')}".rstrip("/")
+        else:
+            continue
+        if git_index.same_tree(dir_path, nix_dir):
+            subtrees[dir_path] = nix_dir
+    return subtrees
+
+
+def subtree_path(rel_path: str, subtrees: dict[str, str]) -> Optional[str]:
+    """Get the nixpkgs path of a file inside one of the identical subtrees, if it is in one."""
+    dir_path = rel_path
+    while "/" in dir_path:
+        dir_path = dir_path.rpartition("/")[0]
+        if (nix_dir := subtrees.get(dir_path)) is not None:
+            return nix_dir + rel_path[len(dir_path):]
+    return None
+
+
+@dataclass
+class SyncState:
+    """Result of the last incremental run: the commits both trees were at and every per-file decision."""
+    corepkgs_commit: str
+    nixpkgs_commit: str
+    config: str
+    # rel_path -> [status, nixpkgs path relative to nixpkgs or None]
+    files: dict[str, list] = field(default_factory=dict)
+    # Recorded paths that were uncommitted or untracked during the run; git no longer
+    # reports them once they are deleted or reverted, so the next run treats them as touched
+    corepkgs_dirty: list[str] = field(default_factory=list)
+    nixpkgs_dirty: list[str] = field(default_factory=list)
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["SyncState"]:
+        try:
+            return cls(**json.loads(path.read_text()))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def save(self, path: Path) -> None:
+        tmp = path.with_name(f"{path.name}.tmp")
+        tmp.write_text(json.dumps(self.__dict__, indent=1, sort_keys=True))
+        tmp.replace(path)
+
+
+def git_head(repo: Path) -> Optional[str]:
+    """Get the commit checked out in repo, or None if it is not a git checkout."""
+    result = subprocess.run(["git", "-C", str(repo), "rev-parse", "HEAD"], capture_output=True, text=True)
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def git_changed_paths(repo: Path, since: str) -> Optional[set[str]]:
+    """List paths relative to repo that differ between commit since and the working tree, including untracked files.
+    
+    Returns None if the changes cannot be determined, e.g. because since is unknown.
+    """
+    changed = set()
+    for cmd in (
+        ["diff", "--name-only", "--no-renames", "--relative", "-z", since, "--"],
+        ["ls-files", "--others", "--exclude-standard", "-z"],
+    ):
+        result = subprocess.run(["git", "-C", str(repo), *cmd], capture_output=True)
+        if result.returncode != 0:
+            return None
+        changed.update(os.fsdecode(p) for p in result.stdout.split(b"\0") if p)
+    return changed
+
+
+def config_fingerprint() -> str:
+    """Hash the configuration that decides how files are mapped and compared."""
+    config = [PATH_MAPPINGS, IGNORE_DIRS, IGNORE_FILES, CHECK_NEW_FILES, CHECK_NEW_FILES_IGNORE_NEW_DIRS]
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def corepkgs_candidates(nixpkgs_rel_path: str) -> set[str]:
+    """Get every corepkgs path whose mapping could resolve to the given nixpkgs path."""
+    candidates = {nixpkgs_rel_path}
+    parts = nixpkgs_rel_path.split("/")
+    if len(parts) == 5 and parts[:2] == ["pkgs", "by-name"] and parts[4] == "package.nix":
+        candidates.add(f"pkgs/{parts[3]}/default.nix")
+    for core_prefix, nix_prefix in mapping_tries()[1].matches(nixpkgs_rel_path):
+        suffix = nixpkgs_rel_path[len(nix_prefix):].lstrip("/")
+        candidates.add(f"{core_prefix}/{suffix}" if suffix else core_prefix)
+    return candidates
+
+
+def touched_directories(state: SyncState, corepkgs: Path, nixpkgs: Path) -> Optional[set[str]]:
+    """Get the corepkgs directories whose results may have changed since state was recorded.
+    
+    Returns None if a full run is needed.
+    """
+    if state.config != config_fingerprint():
+        return None
+    corepkgs_changed = git_changed_paths(corepkgs, state.corepkgs_commit)
+    nixpkgs_changed = git_changed_paths(nixpkgs, state.nixpkgs_commit)
+    if corepkgs_changed is None or nixpkgs_changed is None:
+        return None
+    touched = {get_directory_path(p) for p in corepkgs_changed.union(state.corepkgs_dirty)}
+    for p in nixpkgs_changed.union(state.nixpkgs_dirty):
+        touched.update(get_directory_path(c) for c in corepkgs_candidates(p))
+    return touched
+
+
+def process_io_counters() -> dict[str, int]:
+    """Read the I/O counters of this process from /proc/self/io, empty where it is unavailable."""
+    try:
+        return {k: int(v) for k, v in (line.split(": ") for line in Path("/proc/self/io").read_text().splitlines())}
+    except OSError:
+        return {}
+
+
+def children_cpu_time() -> float:
+    """Get the CPU time used by all finished subprocesses so far."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+@dataclass
+class PhaseProfile:
+    """Measurements for one phase of a run."""
+    name: str
+    start: float
+    wall_seconds: float = 0.0
+    files: int = 0
+    # Bytes read by this process (including pipes from subprocesses), None without /proc
+    bytes_read: Optional[int] = None
+    # CPU time of subprocesses that finished during the phase
+    subprocess_seconds: float = 0.0
+    # Chrome trace thread the phase is drawn on
+    tid: int = 0
+
+
+class Profiler:
+    """Record wall time, file counts, bytes read and subprocess time per phase.
+    
+    Phases run one after another; work done by worker threads is attributed to
+    the phase that started them. Profilers of concurrently synced targets share
+    an origin and are told apart by prefix and tid; their bytes read and
+    subprocess times then include the work of the other targets.
+    """
+
+    def __init__(self, prefix: str = "", tid: int = 0, origin: Optional[float] = None):
+        self.origin = time.perf_counter() if origin is None else origin
+        self.prefix = prefix
+        self.tid = tid
+        self.phases: list[PhaseProfile] = []
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[PhaseProfile]:
+        io_before, children_before = process_io_counters(), children_cpu_time()
+        profile = PhaseProfile(f"{self.prefix}{name}", time.perf_counter(), tid=self.tid)
+        try:
+            yield profile
+        finally:
+            profile.wall_seconds = time.perf_counter() - profile.start
+            profile.subprocess_seconds = children_cpu_time() - children_before
+            if "rchar" in io_before and "rchar" in (io_after := process_io_counters()):
+                profile.bytes_read = io_after["rchar"] - io_before["rchar"]
+            self.phases.append(profile)
+
+    def report(self) -> dict:
+        """Get the measurements as a JSON-serializable dict."""
+        return {
+            "total_seconds": time.perf_counter() - self.origin,
+            "phases": {
+                p.name: {
+                    "wall_seconds": p.wall_seconds,
+                    "files": p.files,
+                    "bytes_read": p.bytes_read,
+                    "subprocess_seconds": p.subprocess_seconds,
+                }
+                for p in self.phases
+            },
+        }
+
+    def chrome_trace(self) -> dict:
+        """Get the phases as complete events in the Chrome trace event format."""
+        return {"traceEvents": [
+            {
+                "name": p.name,
+                "ph": "X",
+                "ts": (p.start - self.origin) * 1e6,
+                "dur": p.wall_seconds * 1e6,
+                "pid": os.getpid(),
+                "tid": p.tid,
+                "args": {"files": p.files, "bytes_read": p.bytes_read, "subprocess_seconds": p.subprocess_seconds},
+            }
+            for p in self.phases
+        ]}
+
+
+def ignore_reason(rel_path: str) -> Optional[str]:
+    """Get the IGNORE_DIRS or IGNORE_FILES entry that makes a file or directory ignored, if any."""
+    for d in IGNORE_DIRS:
+        if rel_path.startswith(f"{d}/") or rel_path == d:
+            return f"in ignored directory {d}"
+    if (name := Path(rel_path).name) in IGNORE_FILES:
+        return f"ignored file name {name}"
+    return None
 
 
 def should_ignore(rel_path: str) -> bool:
     """Check if a file or directory should be ignored."""
-    return (any(rel_path.startswith(f"{d}/") or rel_path == d for d in IGNORE_DIRS) or
-            Path(rel_path).name in IGNORE_FILES)
+    return ignore_reason(rel_path) is not None
+
+
+DECISION_REASONS = {
+    "identical": "content matches nixpkgs",
+    "different": "content differs from nixpkgs",
+    "not_found": "no nixpkgs counterpart through PATH_MAPPINGS",
+    "new": "only present in nixpkgs",
+}
+
+
+def decision_record(status: str, rel_path: str, nixpkgs_file: Optional[Path], nixpkgs: Path) -> dict:
+    """Describe one per-file decision for --format jsonl."""
+    return {
+        "status": status,
+        "path": rel_path,
+        "nixpkgs_path": str(nixpkgs_file.relative_to(nixpkgs)) if nixpkgs_file else None,
+        "reason": ignore_reason(rel_path) if status == "ignored" else DECISION_REASONS[status],
+    }
 
 
 def should_ignore_new_files_dir(core_dir: str, subdir_name: str) -> bool:
@@ -123,53 +669,82 @@ def should_ignore_new_files_dir(core_dir: str, subdir_name: str) -> bool:
             any(rel_path.startswith(f"{d}/") or rel_path == d for d in IGNORE_DIRS))
 
 
-def map_path_using_mappings(path: str, nixpkgs: Path, check_file: bool = True) -> Optional[Path]:
-    """Map corepkgs path to nixpkgs path using PATH_MAPPINGS."""
-    for core_prefix, nix_prefix in PATH_MAPPINGS.items():
-        if path == core_prefix or path.startswith(f"{core_prefix}/"):
-            mapped = nixpkgs / nix_prefix / path[len(core_prefix):].lstrip("/")
-            if not check_file or mapped.is_file():
-                return mapped
+def map_path_using_mappings(
+    path: str,
+    nixpkgs: Path,
+    check_file: bool = True,
+    tree: Optional[TreeSnapshot] = None,
+) -> Optional[Path]:
+    """Map corepkgs path to nixpkgs path using PATH_MAPPINGS, preferring the longest matching prefix."""
+    is_file = tree.is_file if tree else Path.is_file
+    for core_prefix, nix_prefix in mapping_tries()[0].matches(path):
+        mapped = nixpkgs / nix_prefix / path[len(core_prefix):].lstrip("/")
+        if not check_file or is_file(mapped):
+            return mapped
     return None
 
 
-def map_path(rel_path: str, nixpkgs: Path) -> Optional[Path]:
-    """Map corepkgs path to nixpkgs path."""
-    if (exact := nixpkgs / rel_path).is_file():
+def map_path(rel_path: str, nixpkgs: Path, tree: Optional[TreeSnapshot] = None) -> Optional[Path]:
+    """Map corepkgs path to nixpkgs path.
+
+    If tree is a snapshot of nixpkgs, existence checks are answered from it.
+    """
+    is_file = tree.is_file if tree else Path.is_file
+    if is_file(exact := nixpkgs / rel_path):
         return exact
     if rel_path.startswith("pkgs/"):
         parts = rel_path[5:].split("/")
         if len(parts) == 2 and parts[1] == "default.nix":
             by_name = nixpkgs / "pkgs" / "by-name" / parts[0][:2].lower() / parts[0] / "package.nix"
-            if by_name.is_file():
+            if is_file(by_name):
                 return by_name
-        if (direct := nixpkgs / "pkgs" / rel_path[5:]).is_file():
+        if is_file(direct := nixpkgs / "pkgs" / rel_path[5:]):
             return direct
-    return map_path_using_mappings(rel_path, nixpkgs, check_file=True)
+    return map_path_using_mappings(rel_path, nixpkgs, check_file=True, tree=tree)
+
 
+def reverse_map_path(nixpkgs_rel_path: str, corepkgs: Path, tree: Optional[TreeSnapshot] = None) -> Optional[str]:
+    """Map nixpkgs path to corepkgs relative path.
 
-def reverse_map_path(nixpkgs_rel_path: str, corepkgs: Path) -> Optional[str]:
-    """Map nixpkgs path to corepkgs relative path."""
-    if (corepkgs / nixpkgs_rel_path).is_file():
+    If tree is a snapshot of corepkgs, existence checks are answered from it.
+    """
+    is_file = tree.is_file if tree else Path.is_file
+    if is_file(corepkgs / nixpkgs_rel_path):
         return nixpkgs_rel_path
-    for core_prefix, nix_prefix in PATH_MAPPINGS.items():
-        if nixpkgs_rel_path == nix_prefix or nixpkgs_rel_path.startswith(f"{nix_prefix}/"):
-            suffix = nixpkgs_rel_path[len(nix_prefix):].lstrip("/")
-            if core_prefix == "pkgs" and nix_prefix == "pkgs/by-name" and suffix:
-                parts = suffix.split("/")
-                if len(parts) >= 3 and parts[2] == "package.nix":
-                    mapped = corepkgs / "pkgs" / parts[1] / "default.nix"
-                    if mapped.is_file():
-                        return str(mapped.relative_to(corepkgs))
-            mapped = corepkgs / core_prefix / suffix if suffix else corepkgs / core_prefix
-            if mapped.is_file():
-                return str(mapped.relative_to(corepkgs))
+    for core_prefix, nix_prefix in mapping_tries()[1].matches(nixpkgs_rel_path):
+        suffix = nixpkgs_rel_path[len(nix_prefix):].lstrip("/")
+        if core_prefix == "pkgs" and nix_prefix == "pkgs/by-name" and suffix:
+            parts = suffix.split("/")
+            if len(parts) >= 3 and parts[2] == "package.nix":
+                mapped = corepkgs / "pkgs" / parts[1] / "default.nix"
+                if is_file(mapped):
+                    return str(mapped.relative_to(corepkgs))
+        mapped = corepkgs / core_prefix / suffix if suffix else corepkgs / core_prefix
+        if is_file(mapped):
+            return str(mapped.relative_to(corepkgs))
     return None
 
 
-def files_identical(f1: Path, f2: Path) -> bool:
+# Read size for content comparisons, so that memory use does not depend on file size
+COMPARE_CHUNK_SIZE = 1 << 16
+
+
+def files_identical(f1: Path, f2: Path, cache: Optional[DigestCache] = None) -> bool:
+    """Compare two files by content, checking their sizes first.
+
+    Without a cache both files are read chunk by chunk, stopping at the first difference.
+    """
     try:
-        return f1.read_bytes() == f2.read_bytes()
+        if cache is not None:
+            st1, st2 = f1.stat(), f2.stat()
+            return st1.st_size == st2.st_size and cache.digest(f1, st1) == cache.digest(f2, st2)
+        with open(f1, "rb") as a, open(f2, "rb") as b:
+            if (size := os.fstat(a.fileno()).st_size) != os.fstat(b.fileno()).st_size:
+                return False
+            for _ in range(0, size, COMPARE_CHUNK_SIZE):
+                if a.read(COMPARE_CHUNK_SIZE) != b.read(COMPARE_CHUNK_SIZE):
+                    return False
+            return True
     except FileNotFoundError:
         return False
 
@@ -209,76 +784,115 @@ def replace_diff_path(line: str, prefix: str, base_path: str, dir_path: str) ->
     return f"{prefix_slash}{full_path}\t{parts[1].split('\t', 1)[1]}" if has_timestamp else f"{prefix_slash}{full_path}\n"
 
 
+def split_diff_lines(text: str) -> list[str]:
+    """Split text on newlines only, keeping line endings, like diff does."""
+    lines = [f"{line}\n" for line in text.split("\n")]
+    if lines[-1] == "\n":
+        lines.pop()
+    else:
+        lines[-1] = lines[-1][:-1]
+    return lines
+
+
+def diff_timestamp(path: Optional[Path]) -> str:
+    """Format a file's mtime like diff -u does, using the epoch for missing files."""
+    mtime = path.stat().st_mtime if path else 0
+    return datetime.fromtimestamp(mtime).astimezone().strftime("%Y-%m-%d %H:%M:%S.%f %z")
+
+
+def unified_file_diff(rel_path: str, corepkgs_file: Optional[Path], nixpkgs_file: Optional[Path]) -> list[str]:
+    """Diff one file in-process, producing `diff -urN` output with a/ and b/ relative headers."""
+    old = corepkgs_file.read_bytes() if corepkgs_file else b""
+    new = nixpkgs_file.read_bytes() if nixpkgs_file else b""
+    if old == new:
+        return []
+    header = f"diff -urN a/{rel_path} b/{rel_path}\n"
+    if b"\0" in old or b"\0" in new:
+        return [header, f"Binary files a/{rel_path} and b/{rel_path} differ\n"]
+    lines = [header]
+    for line in difflib.unified_diff(
+        split_diff_lines(old.decode(errors="replace")),
+        split_diff_lines(new.decode(errors="replace")),
+        f"a/{rel_path}",
+        f"b/{rel_path}",
+        diff_timestamp(corepkgs_file),
+        diff_timestamp(nixpkgs_file),
+    ):
+        if line.endswith("\n"):
+            lines.append(line)
+        else:
+            # The marker is a line of its own, so hunk filtering does not take it for changed content
+            lines += [f"{line}\n", "\\ No newline at end of file\n"]
+    return lines
+
+
+HUNK_HEADER_RE = re.compile(r"^@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? @@")
+
+# Everything that is not significant content once the hunk's maintainer lines are taken out
+MAINTAINER_NOISE_RE = re.compile(r"maintainers|with|[^\w\s]|_")
+
+
+def is_maintainer_only(change_lines: list[str]) -> bool:
+    """Check whether the added/removed lines of a hunk only touch maintainer lists."""
+    text = " ".join(line[1:].strip().lower() for line in change_lines)
+    if "maintainers" not in text:
+        return False
+    # Significant non-maintainer content left over means the hunk must be kept
+    return len(MAINTAINER_NOISE_RE.sub("", text).strip()) <= 20
+
+
+def filter_maintainer_hunks(lines: Iterable[str]) -> Iterator[str]:
+    """Stream diff lines through, dropping hunks that ONLY contain maintainer changes.
+    
+    Hunks are delimited by the line counts in their @@ header, so only the
+    current hunk is ever held in memory. Dropping whole hunks preserves the
+    line counts of the remaining ones and keeps the patch valid.
+    """
+    hunk: list[str] = []
+    change_lines: list[str] = []
+    old_left = new_left = 0
+    for line in lines:
+        if hunk:
+            if old_left > 0 or new_left > 0 or line.startswith("\\"):
+                hunk.append(line)
+                if line.startswith("-"):
+                    old_left -= 1
+                    change_lines.append(line)
+                elif line.startswith("+"):
+                    new_left -= 1
+                    change_lines.append(line)
+                elif not line.startswith("\\"):
+                    old_left -= 1
+                    new_left -= 1
+                continue
+            # Hunk complete (including any trailing "\ No newline" marker)
+            if not change_lines or not is_maintainer_only(change_lines):
+                yield from hunk
+            hunk, change_lines = [], []
+        if match := HUNK_HEADER_RE.match(line):
+            hunk = [line]
+            old_left, new_left = int(match[1] or 1), int(match[2] or 1)
+        else:
+            # File headers and anything outside hunks are kept as-is
+            yield line
+    if hunk and (not change_lines or not is_maintainer_only(change_lines)):
+        yield from hunk
+
+
 def filter_maintainer_changes(diff_content: str) -> tuple[str, bool]:
     """Filter out maintainer-related changes from diff content.
     
-    Strategy: Remove entire hunks that ONLY contain maintainer changes.
-    This preserves hunk line counts and ensures valid patches.
-    
     Returns:
         tuple: (filtered_diff_content, has_non_maintainer_changes)
     """
     if not diff_content:
         return diff_content, False
     
-    lines = diff_content.splitlines(keepends=True)
     result_lines = []
     has_non_maintainer_changes = False
-    
-    i = 0
-    while i < len(lines):
-        line = lines[i]
-        
-        # Keep file headers
-        if line.startswith("diff ") or line.startswith("---") or line.startswith("+++") or line.startswith("\\"):
-            result_lines.append(line)
-            i += 1
-            continue
-        
-        # Process hunk markers
-        if line.startswith("@@"):
-            hunk_start = i
-            hunk_lines = []
-            i += 1
-            
-            # Collect all lines in this hunk
-            change_lines = []
-            while i < len(lines):
-                hunk_line = lines[i]
-                # Stop at next hunk or file boundary
-                if hunk_line.startswith("@@") or hunk_line.startswith("diff ") or hunk_line.startswith("---"):
-                    break
-                hunk_lines.append(hunk_line)
-                if hunk_line.startswith("+") or hunk_line.startswith("-"):
-                    change_lines.append(hunk_line[1:].strip().lower())
-                i += 1
-            
-            # Check if all changes are maintainer-related
-            all_maintainer = True
-            if change_lines:
-                all_changes_text = " ".join(change_lines)
-                if "maintainers" not in all_changes_text:
-                    all_maintainer = False
-                else:
-                    # Check if there are non-maintainer changes
-                    # Remove maintainer patterns and see if anything remains
-                    test_text = all_changes_text
-                    for pattern in ["maintainers", "with", "[", "]", "=", ";"]:
-                        test_text = test_text.replace(pattern, "")
-                    test_text = "".join(c for c in test_text if c.isalnum() or c.isspace())
-                    if len(test_text.strip()) > 20:  # Significant non-maintainer content
-                        all_maintainer = False
-            
-            # Keep hunk if it has non-maintainer changes
-            if not all_maintainer or not change_lines:
-                has_non_maintainer_changes = True
-                result_lines.append(line)  # Add hunk marker
-                result_lines.extend(hunk_lines)
-            # else: skip entire hunk (maintainer-only)
-        else:
-            # Shouldn't happen, but keep it
-            result_lines.append(line)
-            i += 1
+    for line in filter_maintainer_hunks(diff_content.splitlines(keepends=True)):
+        has_non_maintainer_changes = has_non_maintainer_changes or line.startswith("@@")
+        result_lines.append(line)
     
     filtered_content = "".join(result_lines)
     # Ensure patch ends with newline
@@ -288,14 +902,41 @@ def filter_maintainer_changes(diff_content: str) -> tuple[str, bool]:
     return filtered_content, has_non_maintainer_changes
 
 
+def relativize_diff_headers(lines: Iterable[str], dir_path: str, corepkgs_dir: Path, nixpkgs_dir: Path) -> Iterator[str]:
+    """Rewrite the absolute paths in `diff -urN` file headers to a/ and b/ relative ones."""
+    corepkgs_str, nixpkgs_str = str(corepkgs_dir) + "/", str(nixpkgs_dir) + "/"
+    in_header = False
+    for line in lines:
+        if line.startswith("diff -urN"):
+            in_header = True
+            yield f"diff -urN a/{dir_path} b/{dir_path}\n"
+        elif in_header and line.startswith("---"):
+            yield replace_diff_path(line, "--- a", corepkgs_str, dir_path)
+        elif in_header and line.startswith("+++"):
+            yield replace_diff_path(line, "+++ b", nixpkgs_str, dir_path)
+        else:
+            in_header = in_header and not line.startswith("@@")
+            yield line
+
+
+def patch_file_path(patches_dir: Path, dir_path: str) -> Path:
+    """Get the patch file for a corepkgs directory."""
+    return patches_dir / f"{'root' if dir_path == '.' else dir_path.replace('/', '_')}.patch"
+
+
 def generate_directory_patch(
     dir_path: str,
     files_in_dir: list[tuple[str, Path, Path]],
     corepkgs: Path,
     nixpkgs: Path,
     patches_dir: Path,
+    backend: str = "diff",
 ) -> Optional[Path]:
-    """Generate a patch file for an entire directory."""
+    """Generate a patch file for an entire directory.
+
+    The "diff" backend runs `diff -urN` over both directories; the "python"
+    backend diffs only the files in files_in_dir, in-process.
+    """
     # Skip generating patches for root-level files
     if dir_path == ".":
         return None
@@ -312,127 +953,223 @@ def generate_directory_patch(
     if not nixpkgs_dir.exists() or not nixpkgs_dir.is_dir():
         return None
     
-    result = subprocess.run(
-        ["diff", "-urN", str(corepkgs_dir), str(nixpkgs_dir)],
-        capture_output=True,
-        text=True,
-        errors='replace',
-    )
-    
-    if result.returncode == 0 and not result.stdout:
-        return None
-    
-    lines = result.stdout.splitlines(keepends=True)
-    corepkgs_str, nixpkgs_str = str(corepkgs_dir) + "/", str(nixpkgs_dir) + "/"
+    if backend == "python":
+        # Only the files already known to differ are diffed, with relative headers from the start
+        process = None
+        diff_lines = (
+            line
+            for rel_path, corepkgs_file, nixpkgs_file in sorted(files_in_dir, key=lambda f: f[0])
+            for line in unified_file_diff(rel_path, corepkgs_file, nixpkgs_file)
+        )
+    else:
+        stderr_file = tempfile.TemporaryFile("w+")
+        process = subprocess.Popen(
+            ["diff", "-urN", str(corepkgs_dir), str(nixpkgs_dir)],
+            stdout=subprocess.PIPE,
+            stderr=stderr_file,
+            text=True,
+            errors='replace',
+        )
+        diff_lines = relativize_diff_headers(process.stdout, dir_path, corepkgs_dir, nixpkgs_dir)
     
-    for i, line in enumerate(lines):
-        if line.startswith("diff -urN"):
-            lines[i] = f"diff -urN a/{dir_path} b/{dir_path}\n"
-        elif line.startswith("---"):
-            lines[i] = replace_diff_path(line, "--- a", corepkgs_str, dir_path)
-        elif line.startswith("+++"):
-            lines[i] = replace_diff_path(line, "+++ b", nixpkgs_str, dir_path)
-    
-    diff_content = "".join(lines)
+    patch_file = patch_file_path(patches_dir, dir_path)
+    patch_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = patch_file.with_name(f"{patch_file.name}.tmp")
     
-    # Filter out maintainer changes from the diff
-    filtered_diff, has_non_maintainer_changes = filter_maintainer_changes(diff_content)
+    # Stream the filtered diff straight into the patch file; hunks with only
+    # maintainer changes are dropped on the way
+    has_non_maintainer_changes = False
+    try:
+        with open(tmp_file, "w") as f:
+            f.write(f"# Patch for directory: {dir_path}\n")
+            f.write(f"# Source directory in nixpkgs: {nixpkgs_dir.relative_to(nixpkgs)}\n")
+            f.write(f"# Generated: {datetime.now()}\n")
+            f.write(f"# Files in directory: {len(files_in_dir)}\n")
+            apply_path = patch_file.relative_to(corepkgs if patch_file.is_relative_to(corepkgs) else patches_dir.parent)
+            f.write(f"#\n# To apply from corepkgs root:\n#   patch -p1 < {apply_path}\n#\n")
+            line = "\n"
+            for line in filter_maintainer_hunks(diff_lines):
+                has_non_maintainer_changes = has_non_maintainer_changes or line.startswith("@@")
+                f.write(line)
+            if not line.endswith("\n"):
+                f.write("\n")
+            if process:
+                process.wait()
+                stderr_file.seek(0)
+                if stderr := stderr_file.read():
+                    f.write(stderr)
+                    if not stderr.endswith("\n"):
+                        f.write("\n")
+    finally:
+        if process:
+            process.stdout.close()
+            process.wait()
+            stderr_file.close()
     
     # Skip generating patches if there are no non-maintainer changes
     if not has_non_maintainer_changes:
+        tmp_file.unlink()
         return None
     
-    # Use the filtered diff (without maintainer changes)
-    diff_content = filtered_diff
-    
-    patch_file = patches_dir / f"{'root' if dir_path == '.' else dir_path.replace('/', '_')}.patch"
-    patch_file.parent.mkdir(parents=True, exist_ok=True)
-    
-    with open(patch_file, "w") as f:
-        f.write(f"# Patch for directory: {dir_path}\n")
-        f.write(f"# Source directory in nixpkgs: {nixpkgs_dir.relative_to(nixpkgs)}\n")
-        f.write(f"# Generated: {datetime.now()}\n")
-        f.write(f"# Files in directory: {len(files_in_dir)}\n")
-        f.write(f"#\n# To apply from corepkgs root:\n#   patch -p1 < {patch_file.relative_to(patches_dir.parent)}\n#\n")
-        f.write(diff_content)
-        if not diff_content.endswith("\n"):
-            f.write("\n")
-        if result.stderr:
-            f.write(result.stderr)
-            if not result.stderr.endswith("\n"):
-                f.write("\n")
-    
+    tmp_file.replace(patch_file)
     return patch_file
 
 
-def write_index(patches_dir: Path, stats: DiffStats) -> None:
-    """Write an index file listing all patches."""
+# GNU patch only reports hunks that did not apply at their recorded position
+FUZZY_HUNK_RE = re.compile(r"^Hunk #\d+ succeeded at", re.MULTILINE)
+
+
+@dataclass
+class PatchCheck:
+    """Outcome of applying one patch to a scratch copy of corepkgs."""
+    patch_file: Path
+    # "clean", "fuzzy" (applied with offset or fuzz) or "failed"
+    status: str
+    seconds: float
+    output: str = ""
+
+
+def patch_targets(patch_file: Path) -> list[str]:
+    """List the corepkgs paths a patch modifies, taken from its --- a/ file headers."""
+    targets, in_header = [], False
+    with open(patch_file, errors="replace") as f:
+        for line in f:
+            if line.startswith("diff -urN"):
+                in_header = True
+            elif in_header and line.startswith("--- a/"):
+                targets.append(line[6:].rstrip("\n").split("\t")[0])
+            elif line.startswith("@@"):
+                in_header = False
+    return targets
+
+
+def verify_patch(patch_file: Path, corepkgs: Path, scratch_root: Path) -> PatchCheck:
+    """Apply a patch to a private copy of the files it touches and classify the result."""
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory(dir=scratch_root) as scratch:
+        if existing := [t for t in patch_targets(patch_file) if (corepkgs / t).is_file()]:
+            # Reflinked where the filesystem supports it, copied otherwise, so patch never writes through to corepkgs
+            subprocess.run(["cp", "--reflink=auto", "--parents", "-p", "-t", scratch, "--", *existing],
+                           cwd=corepkgs, check=True, capture_output=True)
+        result = subprocess.run(
+            ["patch", "-p1", "--batch", "--forward", "--no-backup-if-mismatch", "--reject-file=-",
+             "-d", scratch, "-i", str(patch_file)],
+            capture_output=True,
+            text=True,
+            errors="replace",
+        )
+    output = result.stdout + result.stderr
+    status = "failed" if result.returncode else "fuzzy" if FUZZY_HUNK_RE.search(output) else "clean"
+    return PatchCheck(patch_file, status, time.perf_counter() - start, output)
+
+
+def verify_patches(patches_dir: Path, corepkgs: Path, jobs: int = 1) -> list[PatchCheck]:
+    """Check that every patch in patches_dir applies to the current corepkgs tree.
+
+    Each patch is applied on its own, since directory patches include the
+    changes of their subdirectories; with jobs > 1 they are applied concurrently.
+    """
+    patch_files = sorted(patches_dir.glob("*.patch"))
+    with tempfile.TemporaryDirectory(dir=patches_dir, prefix=".verify-") as scratch_root:
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            mapper = executor.map if jobs > 1 else map
+            return list(mapper(lambda patch_file: verify_patch(patch_file, corepkgs, Path(scratch_root)), patch_files))
+
+
+def write_index(patches_dir: Path, stats: DiffStats) -> int:
+    """Write an index file listing all patches and return how many there are."""
     with open(patches_dir / "index.txt", "w") as f:
         f.write(f"# Patches generated between corepkgs and nixpkgs\n# Generated: {datetime.now()}\n#\n")
         f.write(f"# Summary:\n#   Total files processed: {stats.processed}\n")
         f.write(f"#   Files found in nixpkgs: {stats.found}\n#   Files with differences: {stats.different}\n")
         f.write(f"#   Files not found: {stats.not_found}\n#   New files found: {stats.new_files}\n")
         f.write(f"#   Files ignored: {stats.ignored}\n#\n# Patch files:\n")
-        for patch_file in sorted(patches_dir.glob("*.patch")):
+        patch_files = sorted(patches_dir.glob("*.patch"))
+        for patch_file in patch_files:
             f.write(f"#   {patch_file.name}\n")
-        if stats.not_found_list:
+        if stats.not_found:
             f.write(f"#\n# TODO: Files not found in nixpkgs (may need path mapping):\n")
             for nf in stats.not_found_list:
                 f.write(f"#   {nf}\n")
             if stats.not_found > len(stats.not_found_list):
                 f.write(f"#   ... and {stats.not_found - len(stats.not_found_list)} more\n")
-        if stats.new_files_list:
+        if stats.new_files:
             f.write(f"#\n# New files found in nixpkgs (will be added via patches):\n")
             for nf in stats.new_files_list:
                 f.write(f"#   {nf}\n")
             if stats.new_files > len(stats.new_files_list):
                 f.write(f"#   ... and {stats.new_files - len(stats.new_files_list)} more\n")
+    return len(patch_files)
 
 
-def check_new_files(corepkgs: Path, nixpkgs: Path, stats: DiffStats) -> None:
+def check_new_files(
+    corepkgs: Path,
+    nixpkgs: Path,
+    stats: DiffStats,
+    git_index: Optional[GitIndex] = None,
+    core_tree: Optional[TreeSnapshot] = None,
+    nix_tree: Optional[TreeSnapshot] = None,
+    jobs: int = 1,
+) -> None:
     """Check for new files in nixpkgs that don't exist in corepkgs.
     
     For directories in CHECK_NEW_FILES:
     - Checks for files directly in the top-level directory (one level only)
     - For existing subdirectories, checks recursively for new files
+    
+    Both trees are only ever read: directories that exist only in nixpkgs are
+    traversed as empty virtual corepkgs directories through the snapshot
+    listings. Each monitored directory is searched independently (concurrently
+    with jobs > 1) and the results are recorded in CHECK_NEW_FILES order.
     """
     print(f"\nChecking for new files in monitored directories...", file=sys.stderr)
+    core_tree = core_tree or TreeSnapshot(corepkgs)
+    nix_tree = nix_tree or TreeSnapshot(nixpkgs)
     
-    def process_file(nixpkgs_file: Path, corepkgs_file: Path, corepkgs_rel_path: str) -> None:
-        """Helper function to process a single file."""
-        if should_ignore(corepkgs_rel_path) or corepkgs_file.exists():
-            return
-        stats.new_files += 1
-        stats.new_files_list.append(corepkgs_rel_path)
-        dir_path = get_directory_path(corepkgs_rel_path)
-        stats.directories_with_diffs.setdefault(dir_path, []).append((corepkgs_rel_path, None, nixpkgs_file))
-        print(f"  Found new file: {corepkgs_rel_path}", file=sys.stderr)
+    def is_new(corepkgs_rel_path: str) -> bool:
+        """Check whether a mapped corepkgs path is missing from corepkgs."""
+        if should_ignore(corepkgs_rel_path):
+            return False
+        if git_index and corepkgs_rel_path in git_index.corepkgs:
+            return False
+        return not core_tree.exists(corepkgs / corepkgs_rel_path)
     
     def get_corepkgs_path(nixpkgs_file: Path, corepkgs_subdir: Path) -> Optional[str]:
         """Get corepkgs relative path for a nixpkgs file."""
-        return (reverse_map_path(str(nixpkgs_file.relative_to(nixpkgs)), corepkgs) or
+        return (reverse_map_path(str(nixpkgs_file.relative_to(nixpkgs)), corepkgs, core_tree) or
                 str((corepkgs_subdir / nixpkgs_file.name).relative_to(corepkgs)))
     
+    def check_files(corepkgs_subdir: Path, nixpkgs_subdir: Path, found: list[tuple[str, Path]]) -> None:
+        """Check the files directly in a nixpkgs directory."""
+        for nixpkgs_file in nix_tree.iterdir(nixpkgs_subdir):
+            if not nix_tree.is_file(nixpkgs_file) or ".git" in nixpkgs_file.parts:
+                continue
+            if (corepkgs_rel_path := get_corepkgs_path(nixpkgs_file, corepkgs_subdir)) and is_new(corepkgs_rel_path):
+                found.append((corepkgs_rel_path, nixpkgs_file))
+    
     def check_directory_recursive(
         corepkgs_subdir: Path,
         nixpkgs_subdir: Path,
         base_core_dir: str,
+        found: list[tuple[str, Path]],
         skip_direct_files: bool = False
     ) -> None:
-        """Recursively check for new files in a directory."""
-        if not nixpkgs_subdir.exists() or not nixpkgs_subdir.is_dir():
+        """Recursively check for new files in a directory.
+        
+        corepkgs_subdir does not need to exist; a missing directory lists as empty.
+        Directories with the same git tree on both sides cannot contain new files.
+        """
+        if not nix_tree.is_dir(nixpkgs_subdir):
+            return
+        if git_index and git_index.same_tree(str(corepkgs_subdir.relative_to(corepkgs)), str(nixpkgs_subdir.relative_to(nixpkgs))):
             return
         
         # Check files directly in this directory (unless skipped)
         if not skip_direct_files:
-            for nixpkgs_file in nixpkgs_subdir.iterdir():
-                if not nixpkgs_file.is_file() or ".git" in nixpkgs_file.parts:
-                    continue
-                if corepkgs_rel_path := get_corepkgs_path(nixpkgs_file, corepkgs_subdir):
-                    process_file(nixpkgs_file, corepkgs / corepkgs_rel_path, corepkgs_rel_path)
+            check_files(corepkgs_subdir, nixpkgs_subdir, found)
         
-        for nested_corepkgs_subdir in corepkgs_subdir.iterdir():
-            if not nested_corepkgs_subdir.is_dir() or ".git" in nested_corepkgs_subdir.parts:
+        for nested_corepkgs_subdir in core_tree.iterdir(corepkgs_subdir):
+            if not core_tree.is_dir(nested_corepkgs_subdir) or ".git" in nested_corepkgs_subdir.parts:
                 continue
             nested_rel = str(nested_corepkgs_subdir.relative_to(corepkgs))
             nested_subdir = nested_rel[len(base_core_dir) + 1:] if nested_rel.startswith(f"{base_core_dir}/") else nested_corepkgs_subdir.name
@@ -440,96 +1177,415 @@ def check_new_files(corepkgs: Path, nixpkgs: Path, stats: DiffStats) -> None:
                 nested_corepkgs_subdir,
                 nixpkgs_subdir / nested_corepkgs_subdir.name,
                 base_core_dir,
+                found,
                 skip_direct_files=should_ignore_new_files_dir(base_core_dir, nested_subdir)
             )
         
         if not skip_direct_files:
-            for nested_nixpkgs_subdir in nixpkgs_subdir.iterdir():
-                if not nested_nixpkgs_subdir.is_dir() or ".git" in nested_nixpkgs_subdir.parts:
+            for nested_nixpkgs_subdir in nix_tree.iterdir(nixpkgs_subdir):
+                if not nix_tree.is_dir(nested_nixpkgs_subdir) or ".git" in nested_nixpkgs_subdir.parts:
                     continue
                 nested_corepkgs_subdir = corepkgs_subdir / nested_nixpkgs_subdir.name
-                if not nested_corepkgs_subdir.exists():
-                    nested_corepkgs_subdir.mkdir(parents=True, exist_ok=True)
-                    check_directory_recursive(nested_corepkgs_subdir, nested_nixpkgs_subdir, base_core_dir, skip_direct_files=False)
-                    nested_corepkgs_subdir.rmdir()
+                if not core_tree.exists(nested_corepkgs_subdir):
+                    check_directory_recursive(nested_corepkgs_subdir, nested_nixpkgs_subdir, base_core_dir, found)
     
-    for core_dir in CHECK_NEW_FILES:
+    def check_core_dir(core_dir: str) -> list[tuple[str, Path]]:
+        """Find the new files for one monitored directory, without touching stats."""
+        found: list[tuple[str, Path]] = []
         # Only check directories that are in PATH_MAPPINGS
         if core_dir not in PATH_MAPPINGS:
-            continue
-        nixpkgs_dir = map_path_using_mappings(core_dir, nixpkgs, check_file=False)
-        if not nixpkgs_dir or not nixpkgs_dir.is_dir():
-            continue
+            return found
+        nixpkgs_dir = map_path_using_mappings(core_dir, nixpkgs, check_file=False, tree=nix_tree)
+        if not nixpkgs_dir or not nix_tree.is_dir(nixpkgs_dir):
+            return found
         corepkgs_dir = corepkgs / core_dir
-        if not corepkgs_dir.exists():
-            continue
+        if not core_tree.exists(corepkgs_dir):
+            return found
+        if git_index and git_index.same_tree(core_dir, str(nixpkgs_dir.relative_to(nixpkgs))):
+            return found
         
         # Check files directly in top-level directory (skip if directory is ignored)
         if core_dir not in CHECK_NEW_FILES_IGNORE_NEW_DIRS:
-            for nixpkgs_file in nixpkgs_dir.iterdir():
-                if nixpkgs_file.is_file() and ".git" not in nixpkgs_file.parts:
-                    if corepkgs_rel_path := get_corepkgs_path(nixpkgs_file, corepkgs_dir):
-                        process_file(nixpkgs_file, corepkgs / corepkgs_rel_path, corepkgs_rel_path)
+            check_files(corepkgs_dir, nixpkgs_dir, found)
         
-        for corepkgs_subdir in corepkgs_dir.iterdir():
-            if corepkgs_subdir.is_dir() and ".git" not in corepkgs_subdir.parts:
+        for corepkgs_subdir in core_tree.iterdir(corepkgs_dir):
+            if core_tree.is_dir(corepkgs_subdir) and ".git" not in corepkgs_subdir.parts:
                 check_directory_recursive(
                     corepkgs_subdir,
                     nixpkgs_dir / corepkgs_subdir.name,
                     core_dir,
+                    found,
                     skip_direct_files=should_ignore_new_files_dir(core_dir, corepkgs_subdir.name)
                 )
         
         if core_dir not in CHECK_NEW_FILES_IGNORE_NEW_DIRS:
-            for nixpkgs_subdir in nixpkgs_dir.iterdir():
-                if nixpkgs_subdir.is_dir() and ".git" not in nixpkgs_subdir.parts:
+            for nixpkgs_subdir in nix_tree.iterdir(nixpkgs_dir):
+                if nix_tree.is_dir(nixpkgs_subdir) and ".git" not in nixpkgs_subdir.parts:
                     corepkgs_subdir = corepkgs_dir / nixpkgs_subdir.name
-                    if not corepkgs_subdir.exists():
-                        corepkgs_subdir.mkdir(parents=True, exist_ok=True)
-                        check_directory_recursive(corepkgs_subdir, nixpkgs_subdir, core_dir, skip_direct_files=False)
-                        corepkgs_subdir.rmdir()
+                    if not core_tree.exists(corepkgs_subdir):
+                        check_directory_recursive(corepkgs_subdir, nixpkgs_subdir, core_dir, found)
+        return found
+    
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        mapper = executor.map if jobs > 1 else map
+        for found in mapper(check_core_dir, list(CHECK_NEW_FILES)):
+            for corepkgs_rel_path, nixpkgs_file in found:
+                stats.record("new", corepkgs_rel_path, None, nixpkgs_file)
+                print(f"  Found new file: {corepkgs_rel_path}", file=sys.stderr)
 
 
-def process_files(corepkgs: Path, nixpkgs: Path, patches_dir: Path, stats: DiffStats) -> None:
-    """Process all files and generate patches."""
-    for file_path in corepkgs.rglob("*"):
-        if not file_path.is_file() or ".git" in file_path.parts or "result" in str(file_path):
+def iter_corepkgs_files(
+    corepkgs: Path,
+    stats: DiffStats,
+    tree: Optional[TreeSnapshot] = None,
+    only_dirs: Optional[set[str]] = None,
+) -> Iterator[tuple[str, Path]]:
+    """Yield (relative path, absolute path) for every corepkgs file that is not ignored.
+    
+    With only_dirs, only the files directly inside those directories are visited.
+    """
+    tree = tree or TreeSnapshot(corepkgs)
+    if only_dirs is None:
+        rel_paths = tree.walk()
+    else:
+        rel_paths = (
+            f"{dir_path}/{name}" if dir_path != "." else name
+            for dir_path in sorted(only_dirs)
+            for name, kind in tree.listing("" if dir_path == "." else dir_path).items()
+            if kind == "f" and name != ".git"
+        )
+    for rel_path in rel_paths:
+        file_path = corepkgs / rel_path
+        if "result" in str(file_path):
             continue
-        rel_path = str(file_path.relative_to(corepkgs))
         if should_ignore(rel_path):
-            stats.ignored += 1
+            stats.record("ignored", rel_path)
             continue
-        stats.processed += 1
-        if nixpkgs_file := map_path(rel_path, nixpkgs):
-            stats.found += 1
-            if not files_identical(nixpkgs_file, file_path):
-                stats.different += 1
-                dir_path = get_directory_path(rel_path)
-                stats.directories_with_diffs.setdefault(dir_path, []).append((rel_path, file_path, nixpkgs_file))
-        else:
-            stats.not_found += 1
-            stats.not_found_list.append(rel_path)
-        if stats.processed % 100 == 0:
-            print(f"Processed {stats.processed} files, found {stats.found} matches, "
-                  f"{stats.different} different, {stats.not_found} not found", file=sys.stderr)
+        yield rel_path, file_path
+
+
+def compare_file(
+    rel_path: str,
+    file_path: Path,
+    nixpkgs: Path,
+    cache: Optional[DigestCache] = None,
+    git_index: Optional[GitIndex] = None,
+    tree: Optional[TreeSnapshot] = None,
+    subtrees: Optional[dict[str, str]] = None,
+) -> tuple[Optional[Path], bool]:
+    """Map a corepkgs file to nixpkgs and compare it with its counterpart.
+
+    Files inside one of the identical subtrees are identical without looking at them.
+    Blob SHAs from git_index are used when both files are tracked and clean,
+    otherwise the file contents are compared.
+
+    Returns:
+        tuple: (nixpkgs_file or None if not found, whether both files are identical)
+    """
+    if subtrees and (nixpkgs_rel_path := subtree_path(rel_path, subtrees)):
+        return nixpkgs / nixpkgs_rel_path, True
+    if not (nixpkgs_file := map_path(rel_path, nixpkgs, tree)):
+        return None, False
+    if git_index and (identical := git_index.identical(rel_path, str(nixpkgs_file.relative_to(nixpkgs)))) is not None:
+        return nixpkgs_file, identical
+    return nixpkgs_file, files_identical(nixpkgs_file, file_path, cache)
+
+
+def process_files(
+    corepkgs: Path,
+    nixpkgs: Path,
+    patches_dir: Path,
+    stats: DiffStats,
+    jobs: int = 1,
+    cache: Optional[DigestCache] = None,
+    git_index: Optional[GitIndex] = None,
+    diff_backend: str = "diff",
+    only_dirs: Optional[set[str]] = None,
+    previous: Optional[dict[str, list]] = None,
+    profiler: Optional[Profiler] = None,
+    core_tree: Optional[TreeSnapshot] = None,
+) -> None:
+    """Process all files and generate patches.
+
+    With jobs > 1 mapping, comparison and patch generation run in a thread pool;
+    results are consumed in scan order so the collected stats do not depend on scheduling.
+
+    With only_dirs, only files directly inside those directories are compared
+    and only their patches (and those of directories containing them) are
+    regenerated; decisions for all other files are replayed from previous.
+
+    The scan, new file discovery and diff phases are recorded in profiler.
+    A core_tree snapshot can be shared between runs against several nixpkgs trees.
+    """
+    profiler = profiler or Profiler()
+    core_tree, nix_tree = core_tree or TreeSnapshot(corepkgs), TreeSnapshot(nixpkgs)
+    with profiler.phase("scan") as phase:
+        if only_dirs is not None:
+            for rel_path, (status, mapped) in (previous or {}).items():
+                # New files are always rediscovered by check_new_files
+                if status != "new" and get_directory_path(rel_path) not in only_dirs:
+                    stats.record(status, rel_path, corepkgs / rel_path, nixpkgs / mapped if mapped else None)
+        files = list(iter_corepkgs_files(corepkgs, stats, core_tree, only_dirs))
+        subtrees = identical_subtrees(git_index, nix_tree) if git_index else {}
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            mapper = executor.map if jobs > 1 else map
+            results = mapper(lambda f: compare_file(f[0], f[1], nixpkgs, cache, git_index, nix_tree, subtrees), files)
+            for (rel_path, file_path), (nixpkgs_file, identical) in zip(files, results):
+                status = "not_found" if not nixpkgs_file else "identical" if identical else "different"
+                stats.record(status, rel_path, file_path, nixpkgs_file)
+                if stats.processed % 100 == 0:
+                    print(f"Processed {stats.processed} files, found {stats.found} matches, "
+                          f"{stats.different} different, {stats.not_found} not found", file=sys.stderr)
+        phase.files = len(files)
     
-    check_new_files(corepkgs, nixpkgs, stats)
+    with profiler.phase("new_files") as phase:
+        new_files_before = stats.new_files
+        check_new_files(corepkgs, nixpkgs, stats, git_index, core_tree, nix_tree, jobs)
+        phase.files = stats.new_files - new_files_before
+
     print(f"\nGenerating directory patches...", file=sys.stderr)
-    for dir_path, files_in_dir in sorted(stats.directories_with_diffs.items()):
-        if patch_file := generate_directory_patch(dir_path, files_in_dir, corepkgs, nixpkgs, patches_dir):
-            print(f"Generated patch: {patch_file.relative_to(patches_dir.parent)} ({len(files_in_dir)} files)", file=sys.stderr)
+    with profiler.phase("diff") as phase:
+        directories = sorted(stats.directories_with_diffs.items())
+        if only_dirs is not None:
+            # diff -urN patches cover subdirectories too, so parents of touched directories are regenerated as well
+            directories = [
+                (dir_path, files_in_dir) for dir_path, files_in_dir in directories
+                if dir_path in only_dirs or any(d.startswith(f"{dir_path}/") for d in only_dirs)
+            ]
+            for dir_path in only_dirs | {dir_path for dir_path, _ in directories}:
+                patch_file_path(patches_dir, dir_path).unlink(missing_ok=True)
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            mapper = executor.map if jobs > 1 else map
+            patch_files = mapper(
+                lambda d: generate_directory_patch(d[0], d[1], corepkgs, nixpkgs, patches_dir, diff_backend), directories
+            )
+            for (dir_path, files_in_dir), patch_file in zip(directories, patch_files):
+                if patch_file:
+                    print(f"Generated patch: {patch_file.relative_to(patches_dir.parent)} ({len(files_in_dir)} files)", file=sys.stderr)
+        phase.files = sum(len(files_in_dir) for _, files_in_dir in directories)
+
+
+@dataclass
+class SyncTarget:
+    """A nixpkgs tree that corepkgs is synced against, with its own patches directory and results."""
+    name: str
+    nixpkgs: Path
+    patches_dir: Path
+    # Set for revisions, which are checked out into a temporary worktree at nixpkgs
+    commit: Optional[str] = None
+    stats: DiffStats = field(default_factory=DiffStats)
+    checks: list[PatchCheck] = field(default_factory=list)
+
+
+def resolve_targets(specs: list[str], corepkgs: Path) -> tuple[Path, list[tuple[str, Path, Optional[str]]]]:
+    """Resolve --nixpkgs arguments to (name, nixpkgs directory, commit) triples.
+
+    Each spec is a nixpkgs directory or a git revision of the first directory
+    given (../nixpkgs relative to corepkgs if there is none). For revisions the
+    directory is that checkout and commit is the resolved commit, otherwise it is None.
+
+    Returns:
+        tuple: (nixpkgs checkout revisions are resolved in, targets)
+
+    Raises:
+        ValueError: if a spec is neither a directory nor a revision of the nixpkgs checkout
+    """
+    if not specs:
+        default = (corepkgs.parent / "nixpkgs").resolve()
+        return default, [(default.name, default, None)]
+    repo = next((Path(spec).resolve() for spec in specs if Path(spec).is_dir()), (corepkgs.parent / "nixpkgs").resolve())
+    resolved = []
+    for spec in specs:
+        if Path(spec).is_dir():
+            resolved.append((Path(spec).resolve().name, Path(spec).resolve(), None))
+            continue
+        result = subprocess.run(["git", "-C", str(repo), "rev-parse", "--verify", "--quiet", f"{spec}^{{commit}}"],
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            raise ValueError(f"--nixpkgs {spec} is neither a directory nor a git revision of {repo}")
+        resolved.append((spec.replace("/", "_"), repo, result.stdout.strip()))
+    return repo, resolved
+
+
+@contextmanager
+def checkout_targets(repo: Path, resolved: list[tuple[str, Path, Optional[str]]], corepkgs: Path) -> Iterator[list[SyncTarget]]:
+    """Create sync targets from resolve_targets results.
+
+    Revisions are checked out into temporary detached worktrees of repo that
+    are removed on exit. With several targets every one of them gets
+    PATCHES_DIR/<name> as its patches directory, otherwise PATCHES_DIR itself is used.
+    """
+    worktrees = []
+    with tempfile.TemporaryDirectory(prefix="sync-with-nixpkgs-") as scratch:
+        try:
+            targets = []
+            for name, nixpkgs, commit in resolved:
+                if commit:
+                    nixpkgs = Path(scratch) / str(len(targets))
+                    subprocess.run(["git", "-C", str(repo), "worktree", "add", "--detach", "--quiet", str(nixpkgs), commit],
+                                   check=True, capture_output=True)
+                    worktrees.append(nixpkgs)
+                if any(t.name == name for t in targets):
+                    name = f"{name}-{len(targets)}"
+                patches_dir = corepkgs / PATCHES_DIR / name if len(resolved) > 1 else corepkgs / PATCHES_DIR
+                targets.append(SyncTarget(name, nixpkgs, patches_dir, commit))
+            yield targets
+        finally:
+            for worktree in worktrees:
+                subprocess.run(["git", "-C", str(repo), "worktree", "remove", "--force", str(worktree)], capture_output=True)
+
+
+def sync_target(
+    target: SyncTarget,
+    corepkgs: Path,
+    args: argparse.Namespace,
+    core_tree: TreeSnapshot,
+    profiler: Profiler,
+    cache: Optional[DigestCache] = None,
+    corepkgs_git: Optional[tuple[Optional[dict[str, str]], dict[str, str]]] = None,
+    listeners: Iterable[Callable[[str, str, Optional[Path]], None]] = (),
+) -> None:
+    """Compare corepkgs with one target and write its patches, index, incremental state and verification results."""
+    nixpkgs, patches_dir, stats = target.nixpkgs, target.patches_dir, target.stats
+    patches_dir.mkdir(parents=True, exist_ok=True)
+    stats.keep_lists = args.format != "jsonl"
+    stats.listeners.extend(listeners)
+    git_index = None
+    if args.git_index and not (git_index := load_git_index(corepkgs, nixpkgs, *(corepkgs_git or ()))):
+        print("Warning: --git-index needs both trees to be git checkouts, comparing file contents instead", file=sys.stderr)
+
+    # Incremental runs record every decision so the next run can replay the untouched directories
+    heads = (git_head(corepkgs), git_head(nixpkgs)) if args.incremental else (None, None)
+    incremental = None not in heads
+    if args.incremental and not incremental:
+        print("Warning: --incremental needs both trees to be git checkouts, doing a full run", file=sys.stderr)
+    only_dirs, previous, decisions = None, None, {}
+    if incremental:
+        state = SyncState.load(patches_dir / STATE_FILE)
+        if state and (only_dirs := touched_directories(state, corepkgs, nixpkgs)) is not None:
+            previous = state.files
+            print(f"Incremental run: {len(only_dirs)} directories touched since the last sync", file=sys.stderr)
+
+        def remember(status: str, rel_path: str, nixpkgs_file: Optional[Path]) -> None:
+            decisions[rel_path] = [status, str(nixpkgs_file.relative_to(nixpkgs)) if nixpkgs_file else None]
+        stats.listeners.append(remember)
+
+    print(f"Processing files from {corepkgs}...\nComparing with {nixpkgs}...\nPatches will be saved to {patches_dir}...", file=sys.stderr)
+    process_files(corepkgs, nixpkgs, patches_dir, stats, jobs=args.jobs, cache=cache, git_index=git_index,
+                  diff_backend=args.diff_backend, only_dirs=only_dirs, previous=previous, profiler=profiler,
+                  core_tree=core_tree)
+    with profiler.phase("write_index") as phase:
+        if incremental:
+            state_file = patches_dir / STATE_FILE
+            corepkgs_dirty, nixpkgs_dirty = git_changed_paths(corepkgs, heads[0]), git_changed_paths(nixpkgs, heads[1])
+            if corepkgs_dirty is None or nixpkgs_dirty is None:
+                state_file.unlink(missing_ok=True)
+            else:
+                mapped = {m for _, m in decisions.values() if m}
+                SyncState(heads[0], heads[1], config_fingerprint(), decisions,
+                          sorted(corepkgs_dirty & decisions.keys()), sorted(nixpkgs_dirty & mapped)).save(state_file)
+        phase.files = write_index(patches_dir, stats)
+    if args.verify:
+        print(f"\nVerifying patches...", file=sys.stderr)
+        with profiler.phase("verify") as phase:
+            target.checks = verify_patches(patches_dir, corepkgs, args.jobs)
+            phase.files = len(target.checks)
+        for check in target.checks:
+            print(f"  {check.status:<6} {check.patch_file.name} ({check.seconds:.2f}s)", file=sys.stderr)
+            if check.status == "failed":
+                print("".join(f"    {line}\n" for line in check.output.splitlines()), end="", file=sys.stderr)
+
+
+def run_targets(targets: list[SyncTarget], corepkgs: Path, args: argparse.Namespace) -> None:
+    """Sync corepkgs against all targets, concurrently if there are several.
+
+    The corepkgs tree, its git SHAs and the digest cache are read once and shared by all targets.
+    """
+    profiler = Profiler()
+    profile = cProfile.Profile() if args.cprofile else None
+    if profile:
+        profile.enable()
+    cache = DigestCache.load(args.cache.resolve()) if args.cache else None
+    if cache:
+        cache.transient = tuple(f"{target.nixpkgs}/" for target in targets if target.commit)
+    core_tree, corepkgs_git = TreeSnapshot(corepkgs), None
+    if len(targets) > 1:
+        # Listed up front so that concurrent targets never scan the same directory twice
+        with profiler.phase("scan_corepkgs") as phase:
+            phase.files = sum(1 for _ in core_tree.walk())
+            if args.git_index and (corepkgs_blobs := git_blob_index(corepkgs)) is not None:
+                corepkgs_git = (corepkgs_blobs, git_tree_index(corepkgs) or {})
+
+    output_lock = threading.Lock()
+
+    def emitter(target: SyncTarget) -> Callable[[str, str, Optional[Path]], None]:
+        def emit(status: str, rel_path: str, nixpkgs_file: Optional[Path]) -> None:
+            record = decision_record(status, rel_path, nixpkgs_file, target.nixpkgs)
+            if len(targets) > 1:
+                record["target"] = target.name
+            with output_lock:
+                sys.stdout.write(json.dumps(record) + "\n")
+                sys.stdout.flush()
+        return emit
+
+    # Only one cProfile profile can be active at a time, so with several targets
+    # they are synced one after another, each into a profile of its own
+    profile_targets = profile is not None and len(targets) > 1
+
+    def sync(target: SyncTarget, target_profiler: Profiler) -> None:
+        target_profile = cProfile.Profile() if profile_targets else None
+        if target_profile:
+            target_profile.enable()
+        try:
+            sync_target(target, corepkgs, args, core_tree, target_profiler, cache, corepkgs_git,
+                        [emitter(target)] if args.format == "jsonl" else [])
+        finally:
+            if target_profile:
+                target_profile.disable()
+                target_profile.dump_stats(f"{args.cprofile}.{target.name}")
+
+    profilers = [
+        Profiler(f"{target.name}/", i, profiler.origin) if len(targets) > 1 else profiler
+        for i, target in enumerate(targets)
+    ]
+    if profile_targets:
+        profile.disable()
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        mapper = executor.map if len(targets) > 1 and not profile_targets else map
+        list(mapper(lambda t: sync(*t), zip(targets, profilers)))
+    if profile_targets:
+        profile.enable()
+    if cache:
+        # Incremental runs only compare the touched directories, so the other entries are still wanted
+        cache.save(prune=not args.incremental)
+    if len(targets) > 1:
+        profiler.phases.extend(p for target_profiler in profilers for p in target_profiler.phases)
+    if profile:
+        profile.disable()
+        profile.dump_stats(args.cprofile)
+    if args.profile:
+        args.profile.write_text(json.dumps(profiler.report(), indent=2) + "\n")
+        for p in profiler.phases:
+            print(f"Phase {p.name}: {p.wall_seconds:.3f}s, {p.files} files, "
+                  f"{p.bytes_read} bytes read, {p.subprocess_seconds:.3f}s in subprocesses", file=sys.stderr)
+    if args.profile_trace:
+        args.profile_trace.write_text(json.dumps(profiler.chrome_trace()) + "\n")
 
 
 def main() -> None:
     parser = argparse.ArgumentParser(
         description="Generate per-file patches between corepkgs and nixpkgs",
-        epilog="Examples:\n  %(prog)s\n  %(prog)s --nixpkgs /path/to/nixpkgs --corepkgs /path/to/corepkgs",
+        epilog="Examples:\n  %(prog)s\n  %(prog)s --nixpkgs /path/to/nixpkgs --corepkgs /path/to/corepkgs\n"
+               "  %(prog)s --nixpkgs /path/to/nixpkgs --nixpkgs origin/nixos-25.11",
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
     parser.add_argument(
         "--nixpkgs",
-        type=Path,
-        help="Path to nixpkgs repository (default: ../nixpkgs relative to corepkgs)",
+        action="append",
+        metavar="PATH_OR_REV",
+        help="Path to a nixpkgs checkout or a git revision of the first given checkout (default: ../nixpkgs "
+             "relative to corepkgs); repeat to sync against several targets concurrently, each with its own "
+             f"{PATCHES_DIR}/<name> directory",
     )
     parser.add_argument(
         "--corepkgs",
@@ -537,31 +1593,101 @@ def main() -> None:
         default=Path.cwd(),
         help="Path to corepkgs repository (default: current directory)",
     )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=1,
+        help="Number of files to compare and directories to diff concurrently (default: 1)",
+    )
+    parser.add_argument(
+        "--cache",
+        type=Path,
+        help="Cache file for content digests; unchanged files are then compared by stat data only",
+    )
+    parser.add_argument(
+        "--diff-backend",
+        choices=DIFF_BACKENDS,
+        default="diff",
+        help="Generate patches with `diff -urN` per directory or in-process for the differing files only (default: diff)",
+    )
+    parser.add_argument(
+        "--git-index",
+        action="store_true",
+        help="Compare tracked, unmodified files by their git blob SHAs instead of reading them "
+             "and skip directories with the same git tree on both sides",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help=f"Only rescan directories touched by git changes since the last incremental run "
+             f"(state is kept in {PATCHES_DIR}/{STATE_FILE})",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Apply every generated patch to a scratch copy of corepkgs and report whether it applies "
+             "cleanly, with fuzz or not at all; exits with status 1 if any patch fails",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["text", "jsonl"],
+        default="text",
+        help="With jsonl, stream one JSON record per file decision to stdout as it is made "
+             "and do not keep the not-found and new file lists in memory (default: text)",
+    )
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        metavar="FILE",
+        help="Write wall time, file counts, bytes read and subprocess time per phase to FILE as JSON",
+    )
+    parser.add_argument(
+        "--profile-trace",
+        type=Path,
+        metavar="FILE",
+        help="Write the phases to FILE in Chrome trace format (chrome://tracing, Perfetto)",
+    )
+    parser.add_argument(
+        "--cprofile",
+        type=Path,
+        metavar="FILE",
+        help="Dump cProfile statistics to FILE (read with pstats); with several targets they are synced one "
+             "after another, each dumped to FILE.<name>, and FILE only covers the shared setup",
+    )
     args = parser.parse_args()
 
     corepkgs = args.corepkgs.resolve()
-    nixpkgs = args.nixpkgs.resolve() if args.nixpkgs else (corepkgs.parent / "nixpkgs").resolve()
-
-    patches_dir = corepkgs / PATCHES_DIR
-    patches_dir.mkdir(exist_ok=True)
-    
-    stats = DiffStats()
-
-    print(f"Processing files from {corepkgs}...\nComparing with {nixpkgs}...\nPatches will be saved to {patches_dir}...", file=sys.stderr)
-    process_files(corepkgs, nixpkgs, patches_dir, stats)
-    write_index(patches_dir, stats)
-    print(f"\nPatch generation complete!\nPatches saved to: {patches_dir}\nIndex file: {patches_dir / 'index.txt'}", file=sys.stderr)
-    if stats.not_found_list:
-        print(f"\nNot-found files ({len(stats.not_found_list)}):", file=sys.stderr)
-        for nf in sorted(stats.not_found_list):
-            print(f"  {nf}", file=sys.stderr)
-    if stats.new_files_list:
-        print(f"\nNew files found ({len(stats.new_files_list)}):", file=sys.stderr)
-        for nf in sorted(stats.new_files_list):
-            print(f"  {nf}", file=sys.stderr)
-    print(f"\nFiles processed: {stats.processed}, found: {stats.found}, "
-          f"different: {stats.different}, not found: {stats.not_found}, new files: {stats.new_files}", file=sys.stderr)
+    (corepkgs / PATCHES_DIR).mkdir(exist_ok=True)
+    try:
+        repo, resolved = resolve_targets(args.nixpkgs or [], corepkgs)
+    except ValueError as e:
+        parser.error(str(e))
+    with checkout_targets(repo, resolved, corepkgs) as targets:
+        run_targets(targets, corepkgs, args)
 
+    failed = False
+    for target in targets:
+        stats = target.stats
+        heading = f" [{target.name}]" if len(targets) > 1 else ""
+        print(f"\nPatch generation complete{heading}!\nPatches saved to: {target.patches_dir}\n"
+              f"Index file: {target.patches_dir / 'index.txt'}", file=sys.stderr)
+        if stats.not_found_list:
+            print(f"\nNot-found files ({len(stats.not_found_list)}):", file=sys.stderr)
+            for nf in sorted(stats.not_found_list):
+                print(f"  {nf}", file=sys.stderr)
+        if stats.new_files_list:
+            print(f"\nNew files found ({len(stats.new_files_list)}):", file=sys.stderr)
+            for nf in sorted(stats.new_files_list):
+                print(f"  {nf}", file=sys.stderr)
+        print(f"\nFiles processed: {stats.processed}, found: {stats.found}, "
+              f"different: {stats.different}, not found: {stats.not_found}, new files: {stats.new_files}", file=sys.stderr)
+        if args.verify:
+            counts = {status: sum(check.status == status for check in target.checks) for status in ("clean", "fuzzy", "failed")}
+            print(f"Patches verified: {len(target.checks)}, clean: {counts['clean']}, fuzzy: {counts['fuzzy']}, "
+                  f"failed: {counts['failed']}", file=sys.stderr)
+            failed = failed or counts["failed"] > 0
+    if failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -2,6 +2,9 @@
 #!nix-shell -p "python3.withPackages (p: with p; [ ])" -i python3
 """Tests for sync-with-nixpkgs.py"""
 
+import json
+import pstats
+import subprocess
 import tempfile
 from pathlib import Path
 from contextlib import contextmanager
@@ -41,6 +44,8 @@ def config_context(**kwargs):
                     attr[value] = kwargs.get(f"{key}_value", "pkgs/" + value)
             else:
                 setattr(sync_with_nixpkgs, key, value)
+        # PATH_MAPPINGS may have changed, recompile the mapping tries
+        sync_with_nixpkgs._compiled_mappings = None
         yield
     finally:
         for key, original in originals.items():
@@ -52,6 +57,7 @@ def config_context(**kwargs):
                 attr.update(original)
             else:
                 setattr(sync_with_nixpkgs, key, original)
+        sync_with_nixpkgs._compiled_mappings = None
 
 
 def setup_dirs(tmpdir, corepkgs_structure=None, nixpkgs_structure=None):
@@ -95,6 +101,31 @@ def run_check_new_files(corepkgs, nixpkgs, **config):
     return stats
 
 
+def git_init(repo):
+    """Initialise a git repository and stage all files in it."""
+    subprocess.run(["git", "init", "-q", str(repo)], check=True)
+    subprocess.run(["git", "-C", str(repo), "add", "-A"], check=True)
+
+
+def git_commit(repo):
+    """Commit everything in a repository, initialising it first if needed."""
+    if not (repo / ".git").exists():
+        git_init(repo)
+    subprocess.run(["git", "-C", str(repo), "add", "-A"], check=True)
+    subprocess.run(["git", "-C", str(repo), "-c", "user.name=test", "-c", "user.email=test@example.com",
+                    "commit", "-q", "--allow-empty", "-m", "update"], check=True)
+
+
+def run_main(*args):
+    """Run main() with the given command line arguments."""
+    argv = sys.argv
+    sys.argv = ["sync-with-nixpkgs.py", *map(str, args)]
+    try:
+        sync_with_nixpkgs.main()
+    finally:
+        sys.argv = argv
+
+
 # ============================================================================
 # Tests
 # ============================================================================
@@ -188,6 +219,16 @@ class TestReverseMapPath:
             test_file.write_text("test")
             with config_context(PATH_MAPPINGS={"build-support": "pkgs/build-support"}):
                 assert sync_with_nixpkgs.reverse_map_path("pkgs/build-support/default.nix", corepkgs) == "build-support/default.nix"
+    
+    def test_longest_prefix_reverse_mapping(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs = Path(tmpdir) / "corepkgs"
+            for rel_path in ("pkgs/llvm/default.nix", "development/compilers/llvm/default.nix"):
+                (corepkgs / rel_path).parent.mkdir(parents=True, exist_ok=True)
+                (corepkgs / rel_path).write_text("test")
+            mappings = {"development": "pkgs/development", "pkgs/llvm": "pkgs/development/compilers/llvm"}
+            with config_context(PATH_MAPPINGS=mappings):
+                assert sync_with_nixpkgs.reverse_map_path("pkgs/development/compilers/llvm/default.nix", corepkgs) == "pkgs/llvm/default.nix"
 
 
 class TestFilesIdentical:
@@ -211,6 +252,336 @@ class TestFilesIdentical:
             file2 = Path(tmpdir) / "nonexistent.txt"
             file1.write_text("content")
             assert not sync_with_nixpkgs.files_identical(file1, file2)
+    
+    def test_chunked_comparison(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file1, file2 = Path(tmpdir) / "file1.bin", Path(tmpdir) / "file2.bin"
+            data = bytes(range(256)) * 40
+            with config_context(COMPARE_CHUNK_SIZE=1000):
+                for other, expected in (
+                    (data, True),
+                    (data[:-1] + b"x", False),  # differs in the last, partial chunk
+                    (b"x" + data[1:], False),
+                    (data[:2000] + b"x" + data[2001:], False),  # differs right at a chunk boundary
+                    (data + b"x", False),
+                ):
+                    file1.write_bytes(data)
+                    file2.write_bytes(other)
+                    assert sync_with_nixpkgs.files_identical(file1, file2) is expected
+    
+    def test_empty_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file1, file2 = Path(tmpdir) / "file1.txt", Path(tmpdir) / "file2.txt"
+            file1.write_bytes(b"")
+            file2.write_bytes(b"")
+            assert sync_with_nixpkgs.files_identical(file1, file2)
+
+
+class TestTreeSnapshot:
+    def test_kinds(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root, _ = setup_dirs(tmpdir, {"dir/file.nix": "content", "empty": None})
+            (root / "link").symlink_to(root / "dir")
+            tree = sync_with_nixpkgs.TreeSnapshot(root)
+            assert tree.is_file(root / "dir" / "file.nix")
+            assert tree.is_dir(root / "dir") and tree.is_dir(root / "empty") and tree.is_dir(root / "link")
+            assert tree.is_dir(root)
+            assert not tree.exists(root / "missing" / "file.nix")
+            assert not tree.is_file(root / "dir")
+            assert sorted(p.name for p in tree.iterdir(root)) == ["dir", "empty", "link"]
+            assert tree.iterdir(root / "missing") == []
+    
+    def test_listings_are_cached(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root, _ = setup_dirs(tmpdir, {"dir/file.nix": "content"})
+            tree = sync_with_nixpkgs.TreeSnapshot(root)
+            assert not tree.exists(root / "dir" / "new.nix")
+            (root / "dir" / "new.nix").write_text("created after listing")
+            assert not tree.exists(root / "dir" / "new.nix")
+            assert sync_with_nixpkgs.TreeSnapshot(root).exists(root / "dir" / "new.nix")
+    
+    def test_paths_outside_root_use_filesystem(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root, other = setup_dirs(tmpdir, {"a.nix": "a"}, {"b.nix": "b"})
+            tree = sync_with_nixpkgs.TreeSnapshot(root)
+            assert tree.is_file(other / "b.nix")
+    
+    def test_walk_skips_git_and_directory_symlinks(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root, _ = setup_dirs(tmpdir, {"a.nix": "a", "dir/b.nix": "b", ".git/config": "", "sub/.git": "gitdir"})
+            (root / "link").symlink_to(root / "dir")
+            assert sorted(sync_with_nixpkgs.TreeSnapshot(root).walk()) == ["a.nix", "dir/b.nix"]
+    
+    def test_map_path_with_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            _, nixpkgs = setup_dirs(tmpdir, None, {"pkgs/by-name/ll/llvm/package.nix": "test", "pkgs/build-support/a.nix": "a"})
+            tree = sync_with_nixpkgs.TreeSnapshot(nixpkgs)
+            with config_context(PATH_MAPPINGS={"build-support": "pkgs/build-support"}):
+                assert sync_with_nixpkgs.map_path("pkgs/llvm/default.nix", nixpkgs, tree) == nixpkgs / "pkgs/by-name/ll/llvm/package.nix"
+                assert sync_with_nixpkgs.map_path("build-support/a.nix", nixpkgs, tree) == nixpkgs / "pkgs/build-support/a.nix"
+                assert sync_with_nixpkgs.map_path("build-support/b.nix", nixpkgs, tree) is None
+
+
+class TestDigestCache:
+    def test_identical_and_different_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = sync_with_nixpkgs.DigestCache(Path(tmpdir) / "cache.json")
+            file1, file2, file3 = (Path(tmpdir) / name for name in ("file1", "file2", "file3"))
+            file1.write_text("same content")
+            file2.write_text("same content")
+            file3.write_text("other content")
+            assert sync_with_nixpkgs.files_identical(file1, file2, cache)
+            assert not sync_with_nixpkgs.files_identical(file1, file3, cache)
+            assert not sync_with_nixpkgs.files_identical(file1, Path(tmpdir) / "missing", cache)
+    
+    def test_unchanged_file_is_not_reread(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = sync_with_nixpkgs.DigestCache(Path(tmpdir) / "cache.json")
+            file1 = Path(tmpdir) / "file1"
+            file1.write_text("content")
+            cache.digest(file1, file1.stat())
+            cache.entries[str(file1)][3] = "cached"
+            assert cache.digest(file1, file1.stat()) == "cached"
+    
+    def test_changed_stat_invalidates_entry(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = sync_with_nixpkgs.DigestCache(Path(tmpdir) / "cache.json")
+            file1 = Path(tmpdir) / "file1"
+            file1.write_text("content")
+            first = cache.digest(file1, file1.stat())
+            file1.write_text("changed content")
+            assert cache.digest(file1, file1.stat()) != first
+    
+    def test_save_and_load_roundtrip(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_file = Path(tmpdir) / "cache.json"
+            file1 = Path(tmpdir) / "file1"
+            file1.write_text("content")
+            cache = sync_with_nixpkgs.DigestCache(cache_file)
+            digest = cache.digest(file1, file1.stat())
+            cache.save()
+            loaded = sync_with_nixpkgs.DigestCache.load(cache_file)
+            assert loaded.entries[str(file1)][3] == digest
+            assert not loaded.dirty
+    
+    def test_save_prunes_unused_entries(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_file = Path(tmpdir) / "cache.json"
+            file1, file2 = Path(tmpdir) / "file1", Path(tmpdir) / "file2"
+            file1.write_text("content")
+            file2.write_text("other")
+            cache = sync_with_nixpkgs.DigestCache(cache_file)
+            cache.digest(file1, file1.stat())
+            cache.digest(file2, file2.stat())
+            cache.save()
+            loaded = sync_with_nixpkgs.DigestCache.load(cache_file)
+            loaded.digest(file1, file1.stat())
+            loaded.save(prune=False)
+            assert set(sync_with_nixpkgs.DigestCache.load(cache_file).entries) == {str(file1), str(file2)}
+            loaded.save()
+            assert set(sync_with_nixpkgs.DigestCache.load(cache_file).entries) == {str(file1)}
+    
+    def test_transient_files_are_not_cached(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            worktree = Path(tmpdir) / "worktree"
+            worktree.mkdir()
+            file1 = worktree / "file1"
+            file1.write_text("content")
+            cache = sync_with_nixpkgs.DigestCache(Path(tmpdir) / "cache.json", transient=(f"{worktree}/",))
+            assert cache.digest(file1, file1.stat()) == sync_with_nixpkgs.hashlib.sha256(b"content").hexdigest()
+            assert cache.entries == {}
+    
+    def test_load_corrupt_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_file = Path(tmpdir) / "cache.json"
+            cache_file.write_text("not json")
+            assert sync_with_nixpkgs.DigestCache.load(cache_file).entries == {}
+
+
+class TestGitIndex:
+    def test_blob_index_skips_modified_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, _ = setup_dirs(tmpdir, {"a.nix": "a", "dir/b.nix": "b"})
+            git_init(corepkgs)
+            (corepkgs / "a.nix").write_text("modified")
+            blobs = sync_with_nixpkgs.git_blob_index(corepkgs)
+            assert set(blobs) == {"dir/b.nix"}
+    
+    def test_not_a_git_checkout(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, nixpkgs = setup_dirs(tmpdir, {"a.nix": "a"}, {"a.nix": "a"})
+            assert sync_with_nixpkgs.load_git_index(corepkgs, nixpkgs) is None
+    
+    def test_compare_file_by_blob(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, nixpkgs = setup_dirs(
+                tmpdir,
+                {"build-support/same.nix": "same", "build-support/diff.nix": "core", "build-support/dirty.nix": "same"},
+                {"pkgs/build-support/same.nix": "same", "pkgs/build-support/diff.nix": "nix", "pkgs/build-support/dirty.nix": "same"},
+            )
+            git_init(corepkgs)
+            git_init(nixpkgs)
+            (corepkgs / "build-support" / "dirty.nix").write_text("dirty")
+            git_index = sync_with_nixpkgs.load_git_index(corepkgs, nixpkgs)
+            assert "build-support/dirty.nix" not in git_index.corepkgs
+            assert git_index.identical("build-support/same.nix", "pkgs/build-support/same.nix")
+            with config_context(PATH_MAPPINGS={"build-support": "pkgs/build-support"}):
+                for name, expected in (("same", True), ("diff", False), ("dirty", False)):
+                    rel_path = f"build-support/{name}.nix"
+                    _, identical = sync_with_nixpkgs.compare_file(rel_path, corepkgs / rel_path, nixpkgs, git_index=git_index)
+                    assert identical is expected
+
+
+class TestIdenticalSubtrees:
+    def make_repos(self, tmpdir):
+        corepkgs, nixpkgs = setup_dirs(
+            tmpdir,
+            {"build-support/same/a.nix": "a", "build-support/same/sub/b.nix": "b", "build-support/diff/c.nix": "core",
+             "build-support/top.nix": "top"},
+            {"pkgs/build-support/same/a.nix": "a", "pkgs/build-support/same/sub/b.nix": "b",
+             "pkgs/build-support/diff/c.nix": "nix", "pkgs/build-support/diff/new.nix": "new",
+             "pkgs/build-support/top.nix": "top"},
+        )
+        git_commit(corepkgs)
+        git_commit(nixpkgs)
+        return corepkgs, nixpkgs
+
+    def test_tree_index_skips_dirty_directories(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, _ = self.make_repos(tmpdir)
+            assert set(sync_with_nixpkgs.git_tree_index(corepkgs)) == {
+                "build-support", "build-support/same", "build-support/same/sub", "build-support/diff"
+            }
+            (corepkgs / "build-support" / "same" / "sub" / "untracked.nix").write_text("untracked")
+            assert set(sync_with_nixpkgs.git_tree_index(corepkgs)) == {"build-support/diff"}
+            (corepkgs / "build-support" / "diff" / "c.nix").write_text("modified")
+            assert sync_with_nixpkgs.git_tree_index(corepkgs) == {}
+    
+    def test_identical_subtrees(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, nixpkgs = self.make_repos(tmpdir)
+            git_index = sync_with_nixpkgs.load_git_index(corepkgs, nixpkgs)
+            with config_context(PATH_MAPPINGS={"build-support": "pkgs/build-support"}):
+                subtrees = sync_with_nixpkgs.identical_subtrees(git_index, sync_with_nixpkgs.TreeSnapshot(nixpkgs))
+            assert subtrees == {
+                "build-support/same": "pkgs/build-support/same",
+                "build-support/same/sub": "pkgs/build-support/same/sub",
+            }
+            assert sync_with_nixpkgs.subtree_path("build-support/same/sub/b.nix", subtrees) == "pkgs/build-support/same/sub/b.nix"
+            assert sync_with_nixpkgs.subtree_path("build-support/diff/c.nix", subtrees) is None
+    
+    def test_nested_mapping_prevents_skip(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, nixpkgs = self.make_repos(tmpdir)
+            git_index = sync_with_nixpkgs.load_git_index(corepkgs, nixpkgs)
+            with config_context(PATH_MAPPINGS={"build-support": "pkgs/build-support", "build-support/same/sub": "elsewhere"}):
+                subtrees = sync_with_nixpkgs.identical_subtrees(git_index, sync_with_nixpkgs.TreeSnapshot(nixpkgs))
+            assert "build-support/same" not in subtrees
+    
+    def test_process_files_skips_subtrees(self, monkeypatch):
+        mapped = []
+        map_path = sync_with_nixpkgs.map_path
+        monkeypatch.setattr(sync_with_nixpkgs, "map_path", lambda rel_path, *args: mapped.append(rel_path) or map_path(rel_path, *args))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, nixpkgs = self.make_repos(tmpdir)
+            results = []
+            for git_index in (None, sync_with_nixpkgs.load_git_index(corepkgs, nixpkgs)):
+                stats = sync_with_nixpkgs.DiffStats()
+                patches_dir = Path(tmpdir) / f"patches-{len(results)}"
+                patches_dir.mkdir()
+                mapped.clear()
+                with config_context(CHECK_NEW_FILES=["build-support"], PATH_MAPPINGS={"build-support": "pkgs/build-support"}):
+                    sync_with_nixpkgs.process_files(corepkgs, nixpkgs, patches_dir, stats, git_index=git_index)
+                results.append((stats, list(mapped)))
+            (full, full_mapped), (skipping, skipping_mapped) = results
+            assert (full.processed, full.found, full.different) == (skipping.processed, skipping.found, skipping.different) == (4, 4, 1)
+            assert full.new_files_list == skipping.new_files_list == ["build-support/diff/new.nix"]
+            assert "build-support/same/sub/b.nix" in full_mapped
+            assert sorted(skipping_mapped) == ["build-support/diff/c.nix", "build-support/top.nix"]
+
+
+class TestIncremental:
+    def test_corepkgs_candidates(self):
+        with config_context(PATH_MAPPINGS={"pkgs": "pkgs/by-name", "build-support": "pkgs/build-support"}):
+            assert sync_with_nixpkgs.corepkgs_candidates("pkgs/by-name/ll/llvm/package.nix") == {
+                "pkgs/by-name/ll/llvm/package.nix", "pkgs/llvm/default.nix", "pkgs/ll/llvm/package.nix"
+            }
+            assert "build-support/x/a.nix" in sync_with_nixpkgs.corepkgs_candidates("pkgs/build-support/x/a.nix")
+    
+    def test_touched_directories(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, nixpkgs = setup_dirs(
+                tmpdir,
+                {"build-support/x/a.nix": "a", "build-support/y/b.nix": "b"},
+                {"pkgs/build-support/x/a.nix": "a", "pkgs/build-support/y/b.nix": "b"},
+            )
+            git_commit(corepkgs)
+            git_commit(nixpkgs)
+            with config_context(PATH_MAPPINGS={"build-support": "pkgs/build-support"}):
+                state = sync_with_nixpkgs.SyncState(
+                    sync_with_nixpkgs.git_head(corepkgs), sync_with_nixpkgs.git_head(nixpkgs), sync_with_nixpkgs.config_fingerprint()
+                )
+                assert sync_with_nixpkgs.touched_directories(state, corepkgs, nixpkgs) == set()
+                (nixpkgs / "pkgs/build-support/x/a.nix").write_text("changed")
+                git_commit(nixpkgs)
+                (corepkgs / "build-support/z").mkdir()
+                (corepkgs / "build-support/z/untracked.nix").write_text("new")
+                touched = sync_with_nixpkgs.touched_directories(state, corepkgs, nixpkgs)
+                assert {"build-support/x", "build-support/z"} <= touched
+                assert "build-support/y" not in touched
+                state.config = "changed configuration"
+                assert sync_with_nixpkgs.touched_directories(state, corepkgs, nixpkgs) is None
+    
+    def test_incremental_run_matches_full_run(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs_structure = {f"build-support/dir{i}/file{j}.nix": f"content-{i}-{j}\n" for i in range(3) for j in range(3)}
+            nixpkgs_structure = {f"pkgs/build-support/dir{i}/file{j}.nix": f"content-{i}-{j}\n" for i in range(3) for j in range(3)}
+            nixpkgs_structure["pkgs/build-support/dir0/file0.nix"] = "changed upstream\n"
+            corepkgs, nixpkgs = setup_dirs(tmpdir, corepkgs_structure, nixpkgs_structure)
+            git_commit(corepkgs)
+            git_commit(nixpkgs)
+            config = dict(PATH_MAPPINGS={"build-support": "pkgs/build-support"}, CHECK_NEW_FILES=["build-support"],
+                          CHECK_NEW_FILES_IGNORE_NEW_DIRS=[])
+            with config_context(**config):
+                run_main("--corepkgs", corepkgs, "--nixpkgs", nixpkgs, "--incremental")
+                assert (corepkgs / "patches" / "build-support_dir0.patch").exists()
+                
+                (nixpkgs / "pkgs/build-support/dir0/file0.nix").write_text("content-0-0\n")
+                (nixpkgs / "pkgs/build-support/dir1/file1.nix").write_text("changed upstream\n")
+                (nixpkgs / "pkgs/build-support/dir2/added.nix").write_text("added upstream\n")
+                git_commit(nixpkgs)
+                run_main("--corepkgs", corepkgs, "--nixpkgs", nixpkgs, "--incremental")
+                state = sync_with_nixpkgs.SyncState.load(corepkgs / "patches" / sync_with_nixpkgs.STATE_FILE)
+                assert state.nixpkgs_commit == sync_with_nixpkgs.git_head(nixpkgs)
+                incremental_index = (corepkgs / "patches" / "index.txt").read_text()
+                incremental_patches = sorted(p.name for p in (corepkgs / "patches").glob("*.patch"))
+                
+                run_main("--corepkgs", corepkgs, "--nixpkgs", nixpkgs)
+                full_index = (corepkgs / "patches" / "index.txt").read_text()
+            assert incremental_patches == ["build-support_dir1.patch", "build-support_dir2.patch"]
+            # The ignored count includes the patches directory itself, which changes between runs
+            strip = lambda index: sorted(line for line in index.splitlines() if "Generated" not in line and "ignored" not in line)
+            assert strip(incremental_index) == strip(full_index)
+    
+    def test_deleted_untracked_file_is_not_replayed(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, nixpkgs = setup_dirs(
+                tmpdir,
+                {"build-support/x/a.nix": "a\n", "build-support/y/b.nix": "b\n"},
+                {"pkgs/build-support/x/a.nix": "a\n", "pkgs/build-support/y/b.nix": "b\n"},
+            )
+            git_commit(corepkgs)
+            git_commit(nixpkgs)
+            with config_context(PATH_MAPPINGS={"build-support": "pkgs/build-support"}):
+                (corepkgs / "build-support/y/untracked.nix").write_text("untracked\n")
+                run_main("--corepkgs", corepkgs, "--nixpkgs", nixpkgs, "--incremental")
+                assert "build-support/y/untracked.nix" in (corepkgs / "patches" / "index.txt").read_text()
+                
+                (corepkgs / "build-support/y/untracked.nix").unlink()
+                run_main("--corepkgs", corepkgs, "--nixpkgs", nixpkgs, "--incremental")
+                index = (corepkgs / "patches" / "index.txt").read_text()
+            assert "build-support/y/untracked.nix" not in index
+            assert "Files not found: 0" in index
 
 
 class TestGetDirectoryPath:
@@ -296,6 +667,32 @@ class TestMapPathUsingMappings:
             nixpkgs = Path(tmpdir) / "nixpkgs"
             nixpkgs.mkdir()
             assert sync_with_nixpkgs.map_path_using_mappings("nonexistent/path", nixpkgs, check_file=False) is None
+    
+    def test_longest_prefix_wins(self):
+        nixpkgs = Path("/nixpkgs")
+        mappings = {"pkgs": "pkgs/by-name", "pkgs/llvm": "pkgs/development/compilers/llvm"}
+        with config_context(PATH_MAPPINGS=mappings):
+            assert sync_with_nixpkgs.map_path_using_mappings("pkgs/llvm/common/default.nix", nixpkgs, check_file=False) == \
+                nixpkgs / "pkgs/development/compilers/llvm/common/default.nix"
+            assert sync_with_nixpkgs.map_path_using_mappings("pkgs/llvmfoo/default.nix", nixpkgs, check_file=False) == \
+                nixpkgs / "pkgs/by-name/llvmfoo/default.nix"
+    
+    def test_falls_back_to_shorter_prefix(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            nixpkgs = Path(tmpdir) / "nixpkgs"
+            test_file = nixpkgs / "pkgs" / "development" / "interpreters" / "python" / "pkgs" / "hook.nix"
+            test_file.parent.mkdir(parents=True)
+            test_file.write_text("test")
+            mappings = {"python": "pkgs/development/interpreters/python", "python/pkgs": "pkgs/development/python-modules"}
+            with config_context(PATH_MAPPINGS=mappings):
+                assert sync_with_nixpkgs.map_path_using_mappings("python/pkgs/hook.nix", nixpkgs) == test_file
+    
+    def test_mappings_are_recompiled_when_changed(self):
+        nixpkgs = Path("/nixpkgs")
+        with config_context(PATH_MAPPINGS={"foo": "pkgs/foo"}):
+            assert sync_with_nixpkgs.map_path_using_mappings("foo/a.nix", nixpkgs, check_file=False) == nixpkgs / "pkgs/foo/a.nix"
+        with config_context(PATH_MAPPINGS={"foo": "pkgs/bar"}):
+            assert sync_with_nixpkgs.map_path_using_mappings("foo/a.nix", nixpkgs, check_file=False) == nixpkgs / "pkgs/bar/a.nix"
 
 
 class TestCheckNewFiles:
@@ -380,6 +777,52 @@ class TestCheckNewFiles:
             assert "build-support/cc-wrapper/new-deep/level1/level2/file2.nix" in stats.new_files_list
             assert "build-support/cc-wrapper/new-deep/level1/level2/level3/deep-file.nix" in stats.new_files_list
     
+    def test_corepkgs_tree_is_not_modified(self):
+        """New directories are traversed virtually, without creating them in corepkgs."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, nixpkgs = setup_dirs(
+                tmpdir,
+                {"build-support/cc-wrapper/default.nix": "existing"},
+                {
+                    "pkgs/build-support/cc-wrapper/new-deep/level1/file1.nix": "level1",
+                    "pkgs/build-support/new-dir/subdir/file.nix": "new",
+                }
+            )
+            before = sorted(p.relative_to(corepkgs) for p in corepkgs.rglob("*"))
+            stats = run_check_new_files(
+                corepkgs, nixpkgs,
+                CHECK_NEW_FILES=["build-support"],
+                PATH_MAPPINGS={"build-support": "pkgs/build-support"},
+                CHECK_NEW_FILES_IGNORE_NEW_DIRS=[]
+            )
+            assert sorted(p.relative_to(corepkgs) for p in corepkgs.rglob("*")) == before
+            assert "build-support/cc-wrapper/new-deep/level1/file1.nix" in stats.new_files_list
+            assert "build-support/new-dir/subdir/file.nix" in stats.new_files_list
+    
+    def test_concurrent_matches_sequential(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, nixpkgs = setup_dirs(
+                tmpdir,
+                {"build-support/a/default.nix": "existing", "os-specific/linux/default.nix": "existing"},
+                {
+                    "pkgs/build-support/a/new.nix": "new",
+                    "pkgs/build-support/b/new.nix": "new",
+                    "pkgs/os-specific/linux/new.nix": "new",
+                    "pkgs/os-specific/linux/sub/new.nix": "new",
+                }
+            )
+            config = dict(
+                CHECK_NEW_FILES=["build-support", "os-specific"],
+                PATH_MAPPINGS={"build-support": "pkgs/build-support", "os-specific": "pkgs/os-specific"},
+                CHECK_NEW_FILES_IGNORE_NEW_DIRS=[]
+            )
+            sequential = run_check_new_files(corepkgs, nixpkgs, **config)
+            concurrent = sync_with_nixpkgs.DiffStats()
+            with config_context(**config):
+                sync_with_nixpkgs.check_new_files(corepkgs, nixpkgs, concurrent, jobs=4)
+            assert concurrent.new_files_list == sequential.new_files_list
+            assert len(sequential.new_files_list) == 4
+    
     def test_multiple_new_directories_at_same_level(self):
         with tempfile.TemporaryDirectory() as tmpdir:
             nixpkgs_structure = {f"pkgs/build-support/new-dir{i}/file.nix": f"content-{i}" for i in range(1, 4)}
@@ -563,6 +1006,309 @@ class TestCheckNewFiles:
             assert stats.new_files >= 1
 
 
+class TestProcessFiles:
+    def run_process_files(self, tmpdir, corepkgs, nixpkgs, **kwargs):
+        stats = sync_with_nixpkgs.DiffStats()
+        patches_dir = Path(tmpdir) / "patches" / str(kwargs.get("jobs", 1))
+        patches_dir.mkdir(parents=True)
+        with config_context(CHECK_NEW_FILES=[], PATH_MAPPINGS={"build-support": "pkgs/build-support"}):
+            sync_with_nixpkgs.process_files(corepkgs, nixpkgs, patches_dir, stats, **kwargs)
+        return stats
+
+    def test_parallel_matches_serial(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs_structure = {f"build-support/dir{i}/file{j}.nix": f"content-{i}-{j}" for i in range(5) for j in range(30)}
+            nixpkgs_structure = {f"pkgs/build-support/dir{i}/file{j}.nix": f"content-{i}-{j}" for i in range(5) for j in range(30) if j % 7}
+            nixpkgs_structure.update({f"pkgs/build-support/dir{i}/file3.nix": "changed" for i in range(5)})
+            corepkgs, nixpkgs = setup_dirs(tmpdir, corepkgs_structure, nixpkgs_structure)
+            serial = self.run_process_files(tmpdir, corepkgs, nixpkgs)
+            parallel = self.run_process_files(tmpdir, corepkgs, nixpkgs, jobs=8)
+            assert serial.processed == parallel.processed == 150
+            assert serial.not_found == parallel.not_found == 25
+            assert serial.different == parallel.different == 5
+            assert serial.not_found_list == parallel.not_found_list
+            assert serial.directories_with_diffs == parallel.directories_with_diffs
+
+
+class TestProfiler:
+    def test_process_files_phases(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, nixpkgs = setup_dirs(
+                tmpdir,
+                {"build-support/a/same.nix": "same", "build-support/a/changed.nix": "old\n"},
+                {"pkgs/build-support/a/same.nix": "same", "pkgs/build-support/a/changed.nix": "new\n",
+                 "pkgs/build-support/a/added.nix": "added"}
+            )
+            patches_dir = Path(tmpdir) / "patches"
+            patches_dir.mkdir()
+            profiler = sync_with_nixpkgs.Profiler()
+            with config_context(CHECK_NEW_FILES=["build-support"], PATH_MAPPINGS={"build-support": "pkgs/build-support"}):
+                sync_with_nixpkgs.process_files(corepkgs, nixpkgs, patches_dir, sync_with_nixpkgs.DiffStats(), profiler=profiler)
+            report = profiler.report()
+            assert list(report["phases"]) == ["scan", "new_files", "diff"]
+            assert report["phases"]["scan"]["files"] == 2
+            assert report["phases"]["new_files"]["files"] == 1
+            assert report["phases"]["diff"]["files"] == 2
+            assert report["phases"]["diff"]["subprocess_seconds"] >= 0
+            assert all(event["ph"] == "X" for event in profiler.chrome_trace()["traceEvents"])
+
+    def test_main_writes_reports(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, nixpkgs = setup_dirs(
+                tmpdir, {"build-support/a/file.nix": "old\n"}, {"pkgs/build-support/a/file.nix": "new\n"}
+            )
+            out = Path(tmpdir)
+            with config_context(CHECK_NEW_FILES=[], PATH_MAPPINGS={"build-support": "pkgs/build-support"}):
+                run_main("--corepkgs", corepkgs, "--nixpkgs", nixpkgs, "--profile", out / "profile.json",
+                         "--profile-trace", out / "trace.json", "--cprofile", out / "cprofile.out")
+            report = json.loads((out / "profile.json").read_text())
+            assert list(report["phases"]) == ["scan", "new_files", "diff", "write_index"]
+            assert report["phases"]["write_index"]["files"] == 1
+            assert len(json.loads((out / "trace.json").read_text())["traceEvents"]) == 4
+            assert pstats.Stats(str(out / "cprofile.out")).total_calls > 0
+
+
+class TestJsonlFormat:
+    def test_ignore_reason(self):
+        with config_context(IGNORE_DIRS=["pkgs/top-level"], IGNORE_FILES=["README.md"]):
+            assert sync_with_nixpkgs.ignore_reason("pkgs/top-level/all-packages.nix") == "in ignored directory pkgs/top-level"
+            assert sync_with_nixpkgs.ignore_reason("build-support/README.md") == "ignored file name README.md"
+            assert sync_with_nixpkgs.ignore_reason("build-support/default.nix") is None
+
+    def test_lists_not_kept(self):
+        stats = sync_with_nixpkgs.DiffStats(keep_lists=False)
+        stats.record("not_found", "a/missing.nix", Path("/c/a/missing.nix"))
+        stats.record("new", "a/new.nix", None, Path("/n/a/new.nix"))
+        assert (stats.not_found, stats.new_files) == (1, 1)
+        assert stats.not_found_list == stats.new_files_list == []
+        assert list(stats.directories_with_diffs) == ["a"]
+
+    def test_main_streams_records(self, capsys):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, nixpkgs = setup_dirs(
+                tmpdir,
+                {"build-support/a/same.nix": "same", "build-support/a/changed.nix": "old\n",
+                 "build-support/a/missing.nix": "x", "build-support/a/README.md": "docs"},
+                {"pkgs/build-support/a/same.nix": "same", "pkgs/build-support/a/changed.nix": "new\n",
+                 "pkgs/build-support/a/added.nix": "added"}
+            )
+            with config_context(CHECK_NEW_FILES=["build-support"], PATH_MAPPINGS={"build-support": "pkgs/build-support"},
+                                IGNORE_FILES=["README.md"]):
+                run_main("--corepkgs", corepkgs, "--nixpkgs", nixpkgs, "--format", "jsonl")
+            records = {r["path"]: r for r in map(json.loads, capsys.readouterr().out.splitlines())}
+            assert records["build-support/a/same.nix"]["status"] == "identical"
+            assert records["build-support/a/changed.nix"]["nixpkgs_path"] == "pkgs/build-support/a/changed.nix"
+            assert records["build-support/a/changed.nix"]["status"] == "different"
+            assert records["build-support/a/missing.nix"] == {
+                "status": "not_found", "path": "build-support/a/missing.nix", "nixpkgs_path": None,
+                "reason": sync_with_nixpkgs.DECISION_REASONS["not_found"],
+            }
+            assert records["build-support/a/README.md"]["reason"] == "ignored file name README.md"
+            assert records["build-support/a/added.nix"]["status"] == "new"
+            index = (corepkgs / "patches" / "index.txt").read_text()
+            assert "#   ... and 1 more" in index
+
+
+class TestMultipleTargets:
+    def test_resolve_targets(self):
+        import pytest
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, nixpkgs = setup_dirs(tmpdir, {"a.nix": "a"}, {"a.nix": "a"})
+            git_commit(nixpkgs)
+            repo, resolved = sync_with_nixpkgs.resolve_targets([str(nixpkgs), "HEAD"], corepkgs)
+            assert repo == nixpkgs.resolve()
+            assert resolved == [("nixpkgs", nixpkgs.resolve(), None), ("HEAD", nixpkgs.resolve(), sync_with_nixpkgs.git_head(nixpkgs))]
+            with pytest.raises(ValueError):
+                sync_with_nixpkgs.resolve_targets([str(nixpkgs), "no-such-branch"], corepkgs)
+
+    def test_main_syncs_each_target(self, capsys):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, nixpkgs = setup_dirs(
+                tmpdir,
+                {"build-support/a/file.nix": "core\n", "build-support/b/file.nix": "stable\n"},
+                {"pkgs/build-support/a/file.nix": "core\n", "pkgs/build-support/b/file.nix": "stable\n"},
+            )
+            git_commit(nixpkgs)
+            subprocess.run(["git", "-C", str(nixpkgs), "branch", "stable"], check=True)
+            (nixpkgs / "pkgs/build-support/a/file.nix").write_text("unstable\n")
+            git_commit(nixpkgs)
+            with config_context(CHECK_NEW_FILES=[], PATH_MAPPINGS={"build-support": "pkgs/build-support"}):
+                run_main("--corepkgs", corepkgs, "--nixpkgs", nixpkgs, "--nixpkgs", "stable", "--format", "jsonl")
+            records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+            assert {(r["target"], r["path"], r["status"]) for r in records if r["status"] != "ignored"} == {
+                ("nixpkgs", "build-support/a/file.nix", "different"),
+                ("nixpkgs", "build-support/b/file.nix", "identical"),
+                ("stable", "build-support/a/file.nix", "identical"),
+                ("stable", "build-support/b/file.nix", "identical"),
+            }
+            assert sorted(p.name for p in (corepkgs / "patches" / "nixpkgs").glob("*.patch")) == ["build-support_a.patch"]
+            assert "patch -p1 < patches/nixpkgs/build-support_a.patch" in (corepkgs / "patches" / "nixpkgs" / "build-support_a.patch").read_text()
+            assert list((corepkgs / "patches" / "stable").glob("*.patch")) == []
+            assert (corepkgs / "patches" / "stable" / "index.txt").exists()
+            # The temporary worktree of the revision is gone again
+            worktrees = subprocess.run(["git", "-C", str(nixpkgs), "worktree", "list"], capture_output=True, text=True).stdout
+            assert len(worktrees.splitlines()) == 1
+    
+    def test_cprofile_per_target(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, nixpkgs = setup_dirs(tmpdir, {"build-support/a/file.nix": "core\n"}, {"pkgs/build-support/a/file.nix": "core\n"})
+            git_commit(nixpkgs)
+            subprocess.run(["git", "-C", str(nixpkgs), "branch", "stable"], check=True)
+            out = Path(tmpdir) / "cprofile.out"
+            with config_context(CHECK_NEW_FILES=[], PATH_MAPPINGS={"build-support": "pkgs/build-support"}):
+                run_main("--corepkgs", corepkgs, "--nixpkgs", nixpkgs, "--nixpkgs", "stable", "--cprofile", out)
+            for name in ("nixpkgs", "stable"):
+                stats = pstats.Stats(f"{out}.{name}")
+                assert any(func == "process_files" for _, _, func in stats.stats)
+            assert pstats.Stats(str(out)).total_calls > 0
+
+
+class TestVerifyPatches:
+    def make_patch(self, tmpdir, core_lines, nix_lines):
+        corepkgs, nixpkgs = setup_dirs(
+            tmpdir,
+            {"build-support/a/file.nix": "".join(f"{l}\n" for l in core_lines)},
+            {"pkgs/build-support/a/file.nix": "".join(f"{l}\n" for l in nix_lines)},
+        )
+        patches_dir = corepkgs / "patches"
+        patches_dir.mkdir()
+        core_file = corepkgs / "build-support/a/file.nix"
+        files = [("build-support/a/file.nix", core_file, nixpkgs / "pkgs/build-support/a/file.nix")]
+        with config_context(PATH_MAPPINGS={"build-support": "pkgs/build-support"}):
+            assert sync_with_nixpkgs.generate_directory_patch("build-support/a", files, corepkgs, nixpkgs, patches_dir)
+        return corepkgs, patches_dir, core_file
+
+    def test_patch_targets(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            _, patches_dir, _ = self.make_patch(tmpdir, ["-- a/comment", "x"], ["y"])
+            assert sync_with_nixpkgs.patch_targets(patches_dir / "build-support_a.patch") == ["build-support/a/file.nix"]
+
+    def test_clean_fuzzy_and_failed(self):
+        lines = [f"line {i}" for i in range(20)]
+        changed = lines[:10] + ["changed"] + lines[11:]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, patches_dir, core_file = self.make_patch(tmpdir, lines, changed)
+            original = core_file.read_text()
+            [check] = sync_with_nixpkgs.verify_patches(patches_dir, corepkgs)
+            assert check.status == "clean"
+            core_file.write_text("extra\nextra\n" + original)
+            [check] = sync_with_nixpkgs.verify_patches(patches_dir, corepkgs, jobs=2)
+            assert check.status == "fuzzy"
+            core_file.write_text(original.replace("line 10", "conflict"))
+            [check] = sync_with_nixpkgs.verify_patches(patches_dir, corepkgs)
+            assert check.status == "failed"
+            # corepkgs itself is never patched and no scratch directories are left behind
+            assert "conflict" in core_file.read_text()
+            assert [p.name for p in patches_dir.iterdir()] == ["build-support_a.patch"]
+
+
+class TestPythonDiffBackend:
+    def test_split_diff_lines(self):
+        assert sync_with_nixpkgs.split_diff_lines("a\nb\n") == ["a\n", "b\n"]
+        assert sync_with_nixpkgs.split_diff_lines("a\n\x0cb") == ["a\n", "\x0cb"]
+        assert sync_with_nixpkgs.split_diff_lines("") == []
+    
+    def test_identical_files_produce_no_diff(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, nixpkgs = setup_dirs(tmpdir, {"a.nix": "same\n"}, {"a.nix": "same\n"})
+            assert sync_with_nixpkgs.unified_file_diff("a.nix", corepkgs / "a.nix", nixpkgs / "a.nix") == []
+    
+    def test_binary_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, nixpkgs = setup_dirs(tmpdir, {"a.bin": "x\0y"}, {"a.bin": "x\0z"})
+            lines = sync_with_nixpkgs.unified_file_diff("a.bin", corepkgs / "a.bin", nixpkgs / "a.bin")
+            assert lines[-1] == "Binary files a/a.bin and b/a.bin differ\n"
+    
+    def test_patch_applies(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, nixpkgs = setup_dirs(
+                tmpdir,
+                {
+                    "build-support/hook/changed.nix": "".join(f"line {i}\n" for i in range(20)),
+                    "build-support/hook/no-newline.sh": "echo old",
+                },
+                {
+                    "pkgs/build-support/hook/changed.nix": "".join(f"line {i}\n" for i in range(20) if i != 10) + "extra\n",
+                    "pkgs/build-support/hook/no-newline.sh": "echo new",
+                    "pkgs/build-support/hook/new.nix": "{ }\n",
+                },
+            )
+            core_dir, nix_dir = corepkgs / "build-support" / "hook", nixpkgs / "pkgs" / "build-support" / "hook"
+            files_in_dir = [
+                ("build-support/hook/changed.nix", core_dir / "changed.nix", nix_dir / "changed.nix"),
+                ("build-support/hook/no-newline.sh", core_dir / "no-newline.sh", nix_dir / "no-newline.sh"),
+                ("build-support/hook/new.nix", None, nix_dir / "new.nix"),
+            ]
+            patches_dir = Path(tmpdir) / "patches"
+            with config_context(PATH_MAPPINGS={"build-support": "pkgs/build-support"}):
+                patch_file = sync_with_nixpkgs.generate_directory_patch(
+                    "build-support/hook", files_in_dir, corepkgs, nixpkgs, patches_dir, backend="python"
+                )
+            assert patch_file is not None
+            assert "--- a/build-support/hook/changed.nix\t" in patch_file.read_text()
+            result = subprocess.run(["patch", "-p1", "-d", str(corepkgs), "-i", str(patch_file)], capture_output=True, text=True)
+            assert result.returncode == 0, result.stdout + result.stderr
+            for name in ("changed.nix", "no-newline.sh", "new.nix"):
+                assert (core_dir / name).read_bytes() == (nix_dir / name).read_bytes()
+    
+    def test_maintainer_change_without_trailing_newline(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, nixpkgs = setup_dirs(
+                tmpdir,
+                {"build-support/a/default.nix": "{\n  maintainers = with maintainers; [ foo ];"},
+                {"pkgs/build-support/a/default.nix": "{\n  maintainers = with maintainers; [ foo bar ];"},
+            )
+            lines = sync_with_nixpkgs.unified_file_diff(
+                "build-support/a/default.nix", corepkgs / "build-support/a/default.nix", nixpkgs / "pkgs/build-support/a/default.nix"
+            )
+            assert "\\ No newline at end of file\n" in lines
+            files_in_dir = [("build-support/a/default.nix", corepkgs / "build-support/a/default.nix",
+                             nixpkgs / "pkgs/build-support/a/default.nix")]
+            with config_context(PATH_MAPPINGS={"build-support": "pkgs/build-support"}):
+                for backend in sync_with_nixpkgs.DIFF_BACKENDS:
+                    patches_dir = Path(tmpdir) / f"patches-{backend}"
+                    assert sync_with_nixpkgs.generate_directory_patch(
+                        "build-support/a", files_in_dir, corepkgs, nixpkgs, patches_dir, backend=backend
+                    ) is None, backend
+
+
+class TestFilterMaintainerHunks:
+    HEADER = "diff -urN a/x b/x\n--- a/x\t2024-01-01\n+++ b/x\t2024-01-01\n"
+    MAINTAINER_HUNK = "@@ -1,3 +1,3 @@\n {\n-  maintainers = [ ];\n+  maintainers = with maintainers; [ globin ];\n }\n"
+    OTHER_HUNK = "@@ -10 +10 @@\n-  description = \"old description of the package\";\n+  description = \"new description of the package\";\n"
+    
+    def test_drops_maintainer_only_hunk(self):
+        filtered, has_changes = sync_with_nixpkgs.filter_maintainer_changes(self.HEADER + self.MAINTAINER_HUNK + self.OTHER_HUNK)
+        assert has_changes
+        assert filtered == self.HEADER + self.OTHER_HUNK
+    
+    def test_only_maintainer_changes(self):
+        filtered, has_changes = sync_with_nixpkgs.filter_maintainer_changes(self.HEADER + self.MAINTAINER_HUNK)
+        assert not has_changes
+        assert filtered == self.HEADER
+    
+    def test_no_newline_marker_stays_with_its_hunk(self):
+        hunk = "@@ -1 +1 @@\n-  maintainers = [ ];\n\\ No newline at end of file\n+  maintainers = [ a ];\n\\ No newline at end of file\n"
+        filtered, _ = sync_with_nixpkgs.filter_maintainer_changes(self.HEADER + self.OTHER_HUNK + hunk)
+        assert filtered == self.HEADER + self.OTHER_HUNK
+    
+    def test_removed_lines_starting_with_dashes(self):
+        hunk = "@@ -1,2 +1,2 @@\n--- a lua comment\n+-- another lua comment\n context\n"
+        filtered, has_changes = sync_with_nixpkgs.filter_maintainer_changes(self.HEADER + hunk)
+        assert has_changes
+        assert filtered == self.HEADER + hunk
+    
+    def test_streams_lazily(self):
+        consumed = []
+        def lines():
+            for line in (self.HEADER + self.OTHER_HUNK + self.OTHER_HUNK).splitlines(keepends=True):
+                consumed.append(line)
+                yield line
+        stream = sync_with_nixpkgs.filter_maintainer_hunks(lines())
+        assert next(stream).startswith("diff ")
+        assert len(consumed) == 1
+
+
 class TestGenerateDirectoryPatch:
     def test_skip_when_corepkgs_dir_does_not_exist(self):
         """Skip patch generation when corepkgs directory doesn't exist."""
@@ -884,7 +1630,6 @@ class TestGenerateDirectoryPatch:
     
     def test_patch_no_hunk_marker_after_change_line(self):
         """Verify that generated patches are valid and can be applied."""
-        import subprocess
         
         with tempfile.TemporaryDirectory() as tmpdir:
             corepkgs = Path(tmpdir) / "corepkgs"
@@ -953,6 +1698,41 @@ class TestGenerateDirectoryPatch:
                     f"Patch failed to apply: {result.stderr}\nPatch content:\n{patch_file.read_text()[:500]}"
 
 
+
+class TestBenchmark:
+    def test_synthetic_scenario(self):
+        spec = importlib.util.spec_from_file_location("bench_sync_with_nixpkgs", scripts_dir / "bench_sync_with_nixpkgs.py")
+        bench = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(bench)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corepkgs, nixpkgs, mappings = bench.generate_trees(Path(tmpdir), bench.Scenario(200, mapping_depth=3))
+            assert len(list(corepkgs.rglob("*.nix"))) == 200
+            assert "g0/l1/l2" in mappings
+        results = bench.run_scenario(bench.Scenario(200, diff_ratio=0.5))
+        assert set(results) == {"process_files", "check_new_files", "patch_generation"}
+        assert all(result.seconds >= 0 and result.peak_alloc_kib is None for result in results.values())
+        traced = bench.run_scenario(bench.Scenario(200, diff_ratio=0.5), trace_memory=True)
+        assert all(result.peak_alloc_kib > 0 for result in traced.values())
+        slow = bench.PhaseResult(2.0, None, None, None, None)
+        baseline = {"scenario": {"process_files": {"seconds": 1.0}}}
+        assert bench.compare_with_baseline("scenario", {"process_files": slow}, baseline, 2.5) == []
+        assert len(bench.compare_with_baseline("scenario", {"process_files": slow}, baseline, 1.25)) == 1
+    
+    def test_synthetic_config_recompiles_mappings(self):
+        spec = importlib.util.spec_from_file_location("bench_sync_with_nixpkgs", scripts_dir / "bench_sync_with_nixpkgs.py")
+        bench = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(bench)
+        sync = bench.sync_with_nixpkgs
+        nixpkgs = Path("/nixpkgs")
+        for depth in (1, 3):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                _, _, mappings = bench.generate_trees(Path(tmpdir), bench.Scenario(1, mapping_depth=depth))
+            with bench.synthetic_config(mappings):
+                assert len(sync.mapping_tries()[0].matches("g0/l1/l2/d0/f0.nix")) == depth
+        # The real mappings are in effect again afterwards
+        assert sync.map_path_using_mappings("build-support/x", nixpkgs, check_file=False) == nixpkgs / "pkgs/build-support/x"
+
+
 if __name__ == "__main__":
     import pytest
     pytest.main([__file__, "-v"])
@@ -1,85 +1,283 @@
-from importlib.metadata import PathDistribution
-from pathlib import Path
+# Finds Python packages that are installed more than once in a closure.
+#
+# Runs unchanged on Python 2.7 and 3: on Python 3 the closure of $out is
+# walked through nix-support/propagated-build-inputs, on Python 2 the entries
+# of sys.path are scanned. Distributions are read straight from their
+# .dist-info/.egg-info names, without importing pkg_resources or
+# importlib.metadata.
+from __future__ import print_function
+
+import argparse
 import collections
-import sys
+import io
+import json
 import os
-from typing import Dict, List, Set, Tuple
-do_abort: bool = False
-packages: Dict[str, Dict[str, Dict[str, List[str]]]] = collections.defaultdict(dict)
-found_paths: Set[Path] = set()
-out_path: Path = Path(os.getenv("out"))
-version: Tuple[int, int] = sys.version_info
-site_packages_path: str = f'lib/python{version[0]}.{version[1]}/site-packages'
+import re
+import sys
+import threading
+from email.parser import Parser
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # Python 2
+    ThreadPoolExecutor = None
 
-def get_name(dist: PathDistribution) -> str:
-    return dist.metadata['name'].lower().replace('-', '_')
+try:
+    from typing import Callable, Dict, List, Optional, Set, Tuple  # noqa: F401
+except ImportError:  # Python 2
+    pass
 
+# build tools buildPythonPackage puts on sys.path, only ignored when scanning it
+SYS_PATH_EXCEPTIONS = ["setuptools", "pip", "wheel"]
 
-# pretty print a package
-def describe_package(dist: PathDistribution) -> str:
-    return f"{get_name(dist)} {dist.version} ({dist._path})"
+
+# normalize a project name, so that e.g. 'Foo.Bar' and 'foo_bar' compare equal
+def normalize_name(name):
+    # type: (str) -> str
+    return re.sub(r"[-_.]+", "_", name).lower()
 
 
 # pretty print a list of parents (dependency chain)
-def describe_parents(parents: List[str]) -> str:
+def describe_parents(parents):
+    # type: (List[str]) -> str
     if not parents:
         return ""
     return \
-        f"    dependency chain:\n      " \
-        + str(f"\n      ...depending on: ".join(parents))
-
-
-# inserts an entry into 'packages'
-def add_entry(name: str, version: str, store_path: str, parents: List[str]) -> None:
-    packages[name][store_path] = dict(
-        version=version,
-        parents=parents,
-    )
-
-
-# transitively discover python dependencies and store them in 'packages'
-def find_packages(store_path: Path, site_packages_path: str, parents: List[str]) -> None:
-    site_packages: Path = (store_path / site_packages_path)
-    propagated_build_inputs: Path = (store_path / "nix-support/propagated-build-inputs")
-
-    # only visit each path once, to avoid exponential complexity with highly
-    # connected dependency graphs
-    if store_path in found_paths:
-        return
-    found_paths.add(store_path)
-
-    # add the current package to the list
-    if site_packages.exists():
-        for dist_info in site_packages.glob("*.dist-info"):
-            dist: PathDistribution = PathDistribution(dist_info)
-            add_entry(get_name(dist), dist.version, store_path, parents)
-
-    # recursively add dependencies
-    if propagated_build_inputs.exists():
-        with open(propagated_build_inputs, "r") as f:
-            build_inputs: List[str] = f.read().split()
-            for build_input in build_inputs:
-                find_packages(Path(build_input), site_packages_path, parents + [build_input])
-
-
-find_packages(out_path, site_packages_path, [f"this derivation: {out_path}"])
-
-# print all duplicates
-for name, store_paths in packages.items():
-    if len(store_paths) > 1:
-        do_abort = True
-        print("Found duplicated packages in closure for dependency '{}': ".format(name))
-        for store_path, candidate in store_paths.items():
-            print(f"  {name} {candidate['version']} ({store_path})")
-            print(describe_parents(candidate['parents']))
-
-# fail if duplicates were found
-if do_abort:
-    print("")
-    print(
-        "Package duplicates found in closure, see above. Usually this "
-        "happens if two packages depend on different version "
-        "of the same dependency."
-    )
-    sys.exit(1)
+        "    dependency chain:\n      " \
+        + "\n      ...depending on: ".join(parents)
+
+
+# name and version from the METADATA/PKG-INFO file of a distribution
+def read_metadata(path):
+    # type: (str) -> Optional[Tuple[str, str]]
+    try:
+        with io.open(path, encoding="utf-8", errors="replace") as f:
+            metadata = Parser().parse(f, headersonly=True)
+    except (IOError, OSError):
+        return None
+    if not metadata["Name"]:
+        return None
+    return normalize_name(metadata["Name"]), metadata["Version"] or ""
+
+
+# name and version of a distribution, taken from its '{name}-{version}.dist-info',
+# '{name}-{version}[-pyX.Y].egg-info' or '.egg' name; the metadata file is only
+# parsed for names not following these schemes
+def read_distribution(path):
+    # type: (str) -> Optional[Tuple[str, str]]
+    base, ext = os.path.splitext(os.path.basename(path))
+    parts = base.split("-")
+    if ext == ".dist-info":
+        if len(parts) == 2 and all(parts):
+            return normalize_name(parts[0]), parts[1]
+        return read_metadata(os.path.join(path, "METADATA"))
+    if len(parts) >= 2 and all(parts[:2]) and (len(parts) == 2 or parts[2].startswith("py")):
+        return normalize_name(parts[0]), parts[1]
+    if ext == ".egg":
+        return read_metadata(os.path.join(path, "EGG-INFO", "PKG-INFO"))
+    # an .egg-info is either a directory or the PKG-INFO file itself
+    return read_metadata(os.path.join(path, "PKG-INFO") if os.path.isdir(path) else path)
+
+
+# the distributions directly inside a directory, identified by their suffixes
+def scan_directory(path, suffixes):
+    # type: (str, Tuple[str, ...]) -> List[Tuple[str, str]]
+    try:
+        names = sorted(os.listdir(path))
+    except OSError:
+        return []
+    dists = []
+    for name in names:
+        if name.endswith(suffixes):
+            dist = read_distribution(os.path.join(path, name))
+            if dist:
+                dists.append(dist)
+    return dists
+
+
+# the distributions installed in a store path and the store paths it propagates
+def scan_store_path(store_path, site_packages_path):
+    # type: (str, str) -> Tuple[List[Tuple[str, str]], List[str]]
+    dists = scan_directory(os.path.join(store_path, site_packages_path), (".dist-info",))
+    try:
+        with open(os.path.join(store_path, "nix-support", "propagated-build-inputs"), "r") as f:
+            build_inputs = f.read().split()
+    except (IOError, OSError):
+        build_inputs = []
+    return dists, build_inputs
+
+
+class ScanCache(object):
+    # Remembers scan_store_path results for store paths not built by this
+    # derivation; a store path's contents never change, so entries never
+    # need to be invalidated.
+
+    def __init__(self, cache_dir, store_dir, own_outputs):
+        # type: (str, str, Set[str]) -> None
+        self.cache_dir = cache_dir
+        self.store_dir = store_dir
+        # the outputs of this derivation are still being built and are never cached
+        self.own_outputs = own_outputs
+
+    def scan(self, store_path, site_packages_path):
+        # type: (str, str) -> Tuple[List[Tuple[str, str]], List[str]]
+        if os.path.dirname(store_path) != self.store_dir or store_path in self.own_outputs:
+            return scan_store_path(store_path, site_packages_path)
+
+        cache_file = os.path.join(self.cache_dir, os.path.basename(store_path) + ".json")
+        try:
+            with open(cache_file) as f:
+                entry = json.load(f)
+            return [(name, version) for name, version in entry["dists"]], entry["build_inputs"]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+        dists, build_inputs = scan_store_path(store_path, site_packages_path)
+        # written under a unique name and renamed, so concurrent builds never see partial entries
+        tmp_file = "{}.{}.{}.tmp".format(cache_file, os.getpid(), threading.current_thread().ident)
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            with open(tmp_file, "w") as f:
+                json.dump({"dists": dists, "build_inputs": build_inputs}, f)
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError):
+            pass
+        return dists, build_inputs
+
+
+# transitively discover python dependencies of a store path, breadth-first
+#
+# Returns the packages as name -> store path -> versions and, for every visited
+# store path, the store path it was first reached from. Each store path counts
+# as one copy of a package, so only the last version found in it is kept.
+def find_closure_packages(out_path, site_packages_path, cache=None):
+    # type: (str, str, Optional[ScanCache]) -> Tuple[Dict[str, Dict[str, List[str]]], Dict[str, Optional[str]]]
+    scan = cache.scan if cache else scan_store_path
+    packages = collections.defaultdict(collections.OrderedDict)  # type: Dict[str, Dict[str, List[str]]]
+    predecessors = {out_path: None}  # type: Dict[str, Optional[str]]
+    level = [out_path]
+    # one level of the closure at a time; the store paths of a level are
+    # scanned in parallel, as the work is dominated by file system access
+    executor = ThreadPoolExecutor() if ThreadPoolExecutor else None
+    try:
+        while level:
+            next_level = []
+            scans = (executor.map if executor else map)(lambda path: scan(path, site_packages_path), level)
+            for path, (dists, build_inputs) in zip(level, scans):
+                for name, version in dists:
+                    packages[name][path] = [version]
+
+                # only visit each path once, to avoid exponential complexity with
+                # highly connected dependency graphs
+                for build_input in build_inputs:
+                    if build_input not in predecessors:
+                        predecessors[build_input] = path
+                        next_level.append(build_input)
+            level = next_level
+    finally:
+        if executor:
+            executor.shutdown()
+    return packages, predecessors
+
+
+# rebuild the dependency chain leading to a store path from 'predecessors'
+def dependency_chain(store_path, predecessors):
+    # type: (str, Dict[str, Optional[str]]) -> List[str]
+    chain = []
+    path = store_path
+    while predecessors[path] is not None:
+        chain.append(path)
+        path = predecessors[path]
+    chain.append("this derivation: {}".format(path))
+    return chain[::-1]
+
+
+# the distributions found on sys.path, as name -> location -> versions; a
+# directory can hold several versions of the same distribution
+def find_sys_path_packages(paths):
+    # type: (List[str]) -> Dict[str, Dict[str, List[str]]]
+    packages = collections.defaultdict(collections.OrderedDict)  # type: Dict[str, Dict[str, List[str]]]
+    for path in paths:
+        if path.endswith(".egg"):
+            dists = [dist for dist in [read_distribution(path)] if dist]
+        else:
+            dists = scan_directory(path or ".", (".dist-info", ".egg-info", ".egg"))
+        for name, version in dists:
+            if name not in SYS_PATH_EXCEPTIONS:
+                packages[name].setdefault(path, []).append(version)
+    return packages
+
+
+# the packages installed more than once, with the chain that pulls in each copy
+def find_conflicts(packages, chain=lambda path: []):
+    # type: (Dict[str, Dict[str, List[str]]], Callable[[str], List[str]]) -> List[dict]
+    conflicts = []
+    for name, locations in packages.items():
+        # dependency chains are only built for the packages that are reported
+        if sum(len(versions) for versions in locations.values()) > 1:
+            candidates = [
+                {"version": version, "path": path, "dependency_chain": chain(path)}
+                for path, versions in locations.items()
+                for version in versions
+            ]
+            conflicts.append({"name": name, "candidates": candidates})
+    return conflicts
+
+
+def main():
+    # type: () -> None
+    parser = argparse.ArgumentParser(description="Find Python packages installed more than once in a closure")
+    parser.add_argument("--json", metavar="FILE", help="also write the conflicts to FILE as JSON ('-' for stdout)")
+    args = parser.parse_args()
+
+    python_version = "{}.{}".format(*sys.version_info[:2])
+    if sys.version_info[0] >= 3:
+        out_path = os.environ["out"]
+        cache = None
+        if os.environ.get("pythonCatchConflictsCacheDir"):
+            cache = ScanCache(
+                os.path.join(os.environ["pythonCatchConflictsCacheDir"], "python" + python_version),
+                os.environ.get("NIX_STORE", "/nix/store"),
+                set(os.environ[o] for o in os.environ.get("outputs", "out").split() if o in os.environ),
+            )
+        packages, predecessors = find_closure_packages(
+            out_path, "lib/python{}/site-packages".format(python_version), cache
+        )
+        conflicts = find_conflicts(packages, lambda path: dependency_chain(path, predecessors))
+        report = {"python": python_version, "scanned": "closure", "root": out_path, "conflicts": conflicts}
+    else:
+        conflicts = find_conflicts(find_sys_path_packages(sys.path))
+        report = {"python": python_version, "scanned": "sys.path", "root": None, "conflicts": conflicts}
+
+    # the text report goes to stderr when stdout carries the JSON report
+    out = sys.stderr if args.json == "-" else sys.stdout
+
+    # print all duplicates
+    for conflict in conflicts:
+        print("Found duplicated packages in closure for dependency '{}': ".format(conflict["name"]), file=out)
+        for candidate in conflict["candidates"]:
+            print("  {} {} ({})".format(conflict["name"], candidate["version"], candidate["path"]), file=out)
+            if candidate["dependency_chain"]:
+                print(describe_parents(candidate["dependency_chain"]), file=out)
+
+    if args.json == "-":
+        print(json.dumps(report, indent=2))
+    elif args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    # fail if duplicates were found
+    if conflicts:
+        print("", file=out)
+        print(
+            "Package duplicates found in closure, see above. Usually this "
+            "happens if two packages depend on different version "
+            "of the same dependency.",
+            file=out,
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
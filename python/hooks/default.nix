@@ -309,24 +309,13 @@ in
   ) { };
 
   pythonCatchConflictsHook = callPackage (
-    { makePythonHook, setuptools }:
+    { makePythonHook }:
     makePythonHook {
       name = "python-catch-conflicts-hook";
-      substitutions =
-        let
-          useLegacyHook = lib.versionOlder python.pythonVersion "3";
-        in
-        {
-          inherit pythonInterpreter pythonSitePackages;
-          catchConflicts =
-            if useLegacyHook then
-              ../catch_conflicts/catch_conflicts_py2.py
-            else
-              ../catch_conflicts/catch_conflicts.py;
-        }
-        // lib.optionalAttrs useLegacyHook {
-          inherit setuptools;
-        };
+      substitutions = {
+        inherit pythonInterpreter;
+        catchConflicts = ../catch_conflicts/catch_conflicts.py;
+      };
       passthru.tests = import ./python-catch-conflicts-hook-tests.nix {
         inherit pythonOnBuildForHost runCommand;
         inherit lib;
@@ -69,6 +69,24 @@ let
         fi
       '';
     });
+
+  # in addition to expectFailure, check the JSON report the failed build wrote to
+  # $NIX_BUILD_TOP/conflicts.json through pythonCatchConflictsReport
+  expectReport =
+    build: name:
+    let
+      failure = expectFailure build "Found duplicated packages in closure for dependency '${name}'";
+    in
+    lib.overrideDerivation failure (old: {
+      builder = writeShellScript "test-for-report" ''
+        export PATH=${coreutils}/bin:${gnugrep}/bin:$PATH
+        ${old.builder} "$@" || exit 1
+        if ! grep -q '"name": "${name}"' "$NIX_BUILD_TOP/conflicts.json"; then
+          echo "The report should list the conflict for '${name}', but it doesn't"
+          exit 1
+        fi
+      '';
+    });
 in
 {
 
@@ -209,4 +227,20 @@ in
       };
     in
     expectFailure toplevel "Found duplicated packages in closure for dependency 'leaf'";
+
+  # pythonCatchConflictsReport receives the conflicts as JSON
+  writes-conflicts-report =
+    let
+      package = generatePythonPackage {
+        pname = "writes-conflicts-report";
+        propagatedBuildInputs = [
+          pythonPkgs.packaging
+          (customize pythonPkgs.packaging)
+        ];
+        preInstall = ''
+          pythonCatchConflictsReport=$NIX_BUILD_TOP/conflicts.json
+        '';
+      };
+    in
+    expectReport package "packaging";
 }
@@ -9,17 +9,22 @@ violated version constraints.
 
 
 import importlib.metadata
+import os
 import re
 import sys
-import tempfile
 from argparse import ArgumentParser
+from functools import cache
 from zipfile import ZipFile
 
 from packaging.metadata import Metadata, parse_email
 from packaging.requirements import Requirement
 
 argparser = ArgumentParser()
-argparser.add_argument("wheel", help="Path to the .whl file to test")
+argparser.add_argument(
+    "wheels",
+    nargs="+",
+    help="Paths to the .whl files to test, or directories containing them",
+)
 
 
 def error(msg: str) -> None:
@@ -35,16 +40,25 @@ def normalize_name(name: str) -> str:
 
 def get_manifest_text_from_wheel(wheel: str) -> str:
     """
-    Given a path to a wheel, this function will try to extract the
+    Given a path to a wheel, this function will try to read the
     METADATA file in the wheels .dist-info directory.
+
+    The .dist-info directory is named after the distribution and version
+    in the wheel filename, so METADATA is read from the archive directly;
+    only wheels that do not follow this convention are searched for it.
     """
+    parts = os.path.basename(wheel).split("-")
     with ZipFile(wheel) as zipfile:
-        for zipinfo in zipfile.infolist():
-            if zipinfo.filename.endswith(".dist-info/METADATA"):
-                with tempfile.TemporaryDirectory() as tmp:
-                    path = zipfile.extract(zipinfo, path=tmp)
-                    with open(path, encoding="utf-8") as fd:
-                        return fd.read()
+        if len(parts) >= 2:
+            distribution, version = parts[:2]
+            try:
+                return zipfile.read(f"{distribution}-{version}.dist-info/METADATA").decode("utf-8")
+            except KeyError:
+                pass
+
+        for filename in zipfile.namelist():
+            if filename.endswith(".dist-info/METADATA"):
+                return zipfile.read(filename).decode("utf-8")
 
     raise RuntimeError("No METADATA file found in wheel")
 
@@ -60,6 +74,27 @@ def get_metadata(wheel: str) -> Metadata:
     return metadata
 
 
+@cache
+def get_installed_distributions() -> dict[str, importlib.metadata.Distribution]:
+    """
+    Index all distributions in the local environment by their normalized
+    name.
+
+    The environment is scanned once; like importlib.metadata.distribution,
+    the first distribution on sys.path wins when a name occurs twice.
+    Names are taken from the .dist-info/.egg-info directory names, so
+    metadata is only read for distributions whose directory is not named
+    that way, and versions only for the distributions looked up.
+    """
+    distributions: dict[str, importlib.metadata.Distribution] = {}
+    for distribution in importlib.metadata.distributions():
+        # _normalized_name falls back to the metadata for unusual directory names
+        name = getattr(distribution, "_normalized_name", None) or distribution.metadata["Name"]
+        if name:
+            distributions.setdefault(normalize_name(name), distribution)
+    return distributions
+
+
 def test_requirement(requirement: Requirement) -> bool:
     """
     Given a requirement specification, tests whether the dependency can
@@ -72,34 +107,62 @@ def test_requirement(requirement: Requirement) -> bool:
 
     package_name = normalize_name(requirement.name)
 
-    try:
-        package = importlib.metadata.distribution(requirement.name)
-    except importlib.metadata.PackageNotFoundError:
+    distribution = get_installed_distributions().get(package_name)
+    if distribution is None:
         error(f"{package_name} not installed")
         return False
+    version = distribution.version
 
     # Allow prereleases, to give to give us some wiggle-room
     requirement.specifier.prereleases = True
 
-    if requirement.specifier and package.version not in requirement.specifier:
+    if requirement.specifier and version not in requirement.specifier:
         error(
-            f"{package_name}{requirement.specifier} not satisfied by version {package.version}"
+            f"{package_name}{requirement.specifier} not satisfied by version {version}"
         )
         return False
 
     return True
 
 
+def find_wheels(paths: list[str]) -> list[str]:
+    """
+    Expand directories among the given paths to the wheels inside them.
+    """
+    wheels = []
+    for path in paths:
+        if os.path.isdir(path):
+            wheels.extend(
+                sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".whl"))
+            )
+        else:
+            wheels.append(path)
+    return wheels
+
+
+def test_wheel(wheel: str) -> bool:
+    """
+    Given a path to a wheel, tests whether all of its requirements are
+    satisfied by the local environment, reporting every violation.
+    """
+    requirements = get_metadata(wheel).requires_dist or []
+    tests = [test_requirement(requirement) for requirement in requirements]
+    return all(tests)
+
+
 if __name__ == "__main__":
     args = argparser.parse_args()
 
-    metadata = get_metadata(args.wheel)
-    requirements = metadata.requires_dist
-
-    if not requirements:
-        sys.exit(0)
+    wheels = find_wheels(args.wheels)
+    if not wheels:
+        argparser.error(f"no wheels found in {' '.join(args.wheels)}")
 
-    tests = [test_requirement(requirement) for requirement in requirements]
+    failed = []
+    for wheel in wheels:
+        print(f"Checking runtime dependencies for {os.path.basename(wheel)}", flush=True)
+        if not test_wheel(wheel):
+            failed.append(os.path.basename(wheel))
 
-    if not all(tests):
+    if failed:
+        print(f"Runtime dependency check failed for: {', '.join(failed)}", file=sys.stderr)
         sys.exit(1)
@@ -6,10 +6,7 @@ pythonRuntimeDepsCheckHook() {
 
     export PYTHONPATH="$out/@pythonSitePackages@:$PYTHONPATH"
 
-    for wheel in dist/*.whl; do
-        echo "Checking runtime dependencies for $(basename $wheel)"
-        @pythonInterpreter@ @hook@ "$wheel"
-    done
+    @pythonInterpreter@ @hook@ dist
 
     echo "Finished executing pythonRuntimeDepsCheck"
 }
@@ -170,6 +170,11 @@ in
   # Skip setting the PYTHONNOUSERSITE environment variable in wrapped programs
   permitUserSite ? false,
 
+  # Let wrapped programs find the top-level modules of their dependencies through
+  # an index instead of scanning every site-packages directory on each import
+  # (Python 3 only).
+  indexSitePaths ? false,
+
   # Remove bytecode from bin folder.
   # When a Python script has the extension `.py`, bytecode is generated
   # Typically, executables in bin have no extension, so no bytecode is generated.
@@ -9,6 +9,22 @@ will be added before the entries we add here and thus take precedence.
 
 Note the `NIX_PYTHONPATH` environment variable is unset in order to prevent leakage.
 
+When `NIX_PYTHONPATH_MANIFEST` names a manifest written at build time by running
+this file as a script on the same directories, the `sys.path` additions and `.pth`
+import lines recorded in it are replayed instead, without listing any directory
+or reading any `.pth` file. If the manifest cannot be read, is malformed or is
+incomplete, `NIX_PYTHONPATH` is used as usual. `NIX_PYTHONPATH_MANIFEST` is unset
+as well.
+
+Programs wrapped by `wrapPythonPrograms` with `indexSitePaths` pass their site
+directories to `index_sitedirs` (Python 3 only). Their `.pth` files are processed
+as usual, but the directories themselves are not left on `sys.path`. A finder placed
+before `PathFinder` looks up top-level modules in an index of their contents
+instead, so that imports do not scan them one by one. Modules on the remaining
+`sys.path` still take precedence, and namespace packages get their portions from
+both. Tools that walk `sys.path` themselves (`pkgutil.iter_modules`,
+`pkg_resources`) do not see the indexed directories.
+
 Similarly, this module listens to the environment variable `NIX_PYTHONEXECUTABLE`
 and sets `sys.executable` to its value.
 """
@@ -17,8 +33,174 @@ import sys
 import os
 import functools
 
+
+def freeze_sitedirs(sitedirs):
+    """Record the `sys.path` additions and `.pth` import lines of `site.addsitedir`, in order.
+
+    Import lines are recorded as `<sitedir>\t<line>`, with the directory of their `.pth` file.
+    """
+    operations = []
+    for sitedir in sitedirs:
+        sitedir = os.path.abspath(sitedir)
+        operations.append(('path', sitedir))
+        try:
+            names = os.listdir(sitedir)
+        except OSError:
+            continue
+        for name in sorted(n for n in names if n.endswith('.pth') and not n.startswith('.')):
+            with open(os.path.join(sitedir, name)) as f:
+                for line in f:
+                    if line.startswith('#') or not line.strip():
+                        continue
+                    if line.startswith(('import ', 'import\t')):
+                        operations.append(('exec', '%s\t%s' % (sitedir, line.rstrip())))
+                        continue
+                    path = os.path.abspath(os.path.join(sitedir, line.rstrip()))
+                    if os.path.exists(path):
+                        operations.append(('path', path))
+    return operations
+
+
+def read_manifest(path):
+    """Read the operations recorded by `freeze_sitedirs`.
+
+    Returns None if the manifest cannot be read, has a malformed line or lacks
+    the final `end` line, e.g. because it was truncated.
+    """
+    try:
+        with open(path) as f:
+            lines = f.read().split('\n')
+    except (IOError, OSError):
+        return None
+    if lines[-2:] != ['end', '']:
+        return None
+    operations = []
+    for line in lines[:-2]:
+        kind, _, value = line.partition(' ')
+        if kind not in ('path', 'exec') or not value or (kind == 'exec' and '\t' not in value):
+            return None
+        operations.append((kind, value))
+    return operations
+
+
+def apply_manifest(operations, manifest):
+    """Replay recorded operations, skipping paths that are already on `sys.path` like `site` does."""
+    known_paths = set(sys.path)
+    for kind, value in operations:
+        if kind == 'path':
+            if value not in known_paths:
+                known_paths.add(value)
+                sys.path.append(value)
+        elif kind == 'exec':
+            # Like in site.addpackage, the line runs with a sitedir local; the
+            # .pth files of setuptools namespace packages read it from this frame
+            sitedir, line = value.split('\t', 1)
+            try:
+                exec(line)
+            except Exception as e:
+                sys.stderr.write('Error processing line from %s:\n  %s\n%r\n' % (manifest, line, e))
+
+
+def is_namespace_spec(spec):
+    # Namespace packages have no origin; Python < 3.7 calls it 'namespace'
+    return spec.submodule_search_locations is not None and spec.origin in (None, 'namespace')
+
+
+class NixPathFinder(object):
+    """Find top-level modules in indexed site directories, ahead of `PathFinder`.
+
+    The index maps every name in the directories, up to its first dot, to the
+    directories containing it. It is built on the first lookup, listing each
+    directory once. Names it does not contain are left to `PathFinder`. Other
+    names are looked up on `sys.path` first and then in just the directories
+    containing them, merging the portions of namespace packages.
+    """
+
+    def __init__(self, paths):
+        self.paths = paths
+        self._index = None
+
+    def _locations(self, name):
+        if self._index is None:
+            index = {}
+            for path in self.paths:
+                try:
+                    names = os.listdir(path)
+                except OSError:
+                    continue
+                for entry in names:
+                    locations = index.setdefault(entry.partition('.')[0], [])
+                    if not locations or locations[-1] != path:
+                        locations.append(path)
+            self._index = index
+        return self._index.get(name)
+
+    def find_spec(self, fullname, path=None, target=None):
+        # Submodules are found through the __path__ of their package
+        if path is not None or '.' in fullname:
+            return None
+        locations = self._locations(fullname)
+        if not locations:
+            return None
+        from importlib.machinery import PathFinder
+        spec = PathFinder.find_spec(fullname)
+        if spec is not None and not is_namespace_spec(spec):
+            return spec
+        indexed = PathFinder.find_spec(fullname, locations)
+        if indexed is None:
+            return spec
+        if not is_namespace_spec(indexed):
+            return indexed
+        # The portions on sys.path come first, as they would with the directories on sys.path
+        portions = list(spec.submodule_search_locations) if spec is not None else []
+        indexed.submodule_search_locations = portions + list(indexed.submodule_search_locations)
+        return indexed
+
+    def invalidate_caches(self):
+        self._index = None
+
+
+class NixDistributionFinder(object):
+    """Find the distributions in the indexed site directories for `importlib.metadata`, after those on `sys.path`."""
+
+    def __init__(self, paths):
+        self.paths = paths
+
+    def find_spec(self, fullname, path=None, target=None):
+        return None
+
+    def find_distributions(self, context=None):
+        from importlib.metadata import DistributionFinder, MetadataPathFinder
+        context = context or DistributionFinder.Context()
+        # Searches of an explicit path are not about sys.path
+        if 'path' in vars(context):
+            return iter(())
+        return MetadataPathFinder.find_distributions(DistributionFinder.Context(name=context.name, path=self.paths))
+
+
+def index_sitedirs(sitedirs):
+    """Add site directories like `site.addsitedir`, resolving their top-level modules through `NixPathFinder`."""
+    sys_path_length = len(sys.path)
+    functools.reduce(lambda k, p: site.addsitedir(p, k), sitedirs, site._init_pathinfo())
+    if sys.version_info < (3, 8):
+        return
+    from importlib.machinery import PathFinder
+    # Only the directories themselves move to the index; .pth additions stay on sys.path
+    indexed = set(os.path.abspath(p) for p in sitedirs)
+    added = sys.path[sys_path_length:]
+    sys.path[sys_path_length:] = [p for p in added if p not in indexed]
+    paths = [p for p in added if p in indexed]
+    position = sys.meta_path.index(PathFinder) if PathFinder in sys.meta_path else len(sys.meta_path)
+    sys.meta_path.insert(position, NixPathFinder(paths))
+    sys.meta_path.append(NixDistributionFinder(paths))
+
+
+manifest = os.environ.pop('NIX_PYTHONPATH_MANIFEST', None)
 paths = os.environ.pop('NIX_PYTHONPATH', None)
-if paths:
+operations = read_manifest(manifest) if manifest else None
+if operations is not None:
+    apply_manifest(operations, manifest)
+elif paths:
     functools.reduce(lambda k, p: site.addsitedir(p, k), paths.split(':'), site._init_pathinfo())
 
 # Check whether we are in a venv or virtualenv.
@@ -37,3 +219,9 @@ if not in_venv:
         # Sysconfig does not like it when sys.prefix is set to None
         sys.prefix = sys.exec_prefix = prefix
         site.PREFIXES.insert(0, prefix)
+
+if __name__ == '__main__':
+    # Write the manifest for the site directories given as arguments to stdout
+    for kind, value in freeze_sitedirs(sys.argv[1:]):
+        sys.stdout.write('%s %s\n' % (kind, value))
+    sys.stdout.write('end\n')
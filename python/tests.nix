@@ -186,6 +186,115 @@ let
           '';
     };
 
+  # An environment with freezeSitePaths records the sys.path additions of its
+  # site-packages at build time; replaying them through NIX_PYTHONPATH_MANIFEST,
+  # as its wrapped programs do, must give the sys.path site.addsitedir builds.
+  sitePathsTests = lib.optionalAttrs (python.isPy3k && python.implementation != "graal") (
+    let
+      # setuptools ships a .pth file with an import line
+      extraLibs = [ python.pkgs.setuptools ];
+      env = python.buildEnv.override { inherit extraLibs; };
+      frozenEnv = python.buildEnv.override {
+        inherit extraLibs;
+        freezeSitePaths = true;
+      };
+    in
+    {
+      frozen-site-paths = runCommand "${python.name}-frozen-site-paths" { } ''
+        sys_path() {
+          env "$@" ${python.interpreter} -c 'import sys; print("\n".join(sys.path))' | sed "s|${frozenEnv}|ENV|;s|${env}|ENV|"
+        }
+        manifest=${frozenEnv}/.nix-python-site-paths
+        sys_path NIX_PYTHONPATH=${env}/${python.sitePackages} > unfrozen
+        grep -q "ENV/${python.sitePackages}" unfrozen
+
+        # The manifest alone is enough
+        sys_path NIX_PYTHONPATH_MANIFEST=$manifest > frozen
+        diff -u unfrozen frozen
+
+        # Incomplete or malformed manifests fall back to NIX_PYTHONPATH
+        head -n 1 $manifest > truncated
+        (echo; cat $manifest) > blank-line
+        for broken in /dev/null truncated blank-line; do
+          sys_path NIX_PYTHONPATH=${frozenEnv}/${python.sitePackages} NIX_PYTHONPATH_MANIFEST=$broken > fallback
+          diff -u unfrozen fallback
+        done
+        touch $out
+      '';
+
+      # A PEP 420 namespace package keeps its portions from both PYTHONPATH and
+      # the NIX_PYTHONPATH directories, with and without a manifest
+      namespace-site-paths = runCommand "${python.name}-namespace-site-paths" { } ''
+        mkdir -p site/nsp pythonpath/nsp
+        echo 'name = "a"' > site/nsp/a.py
+        echo 'name = "b"' > pythonpath/nsp/b.py
+        ${python.interpreter} ${./sitecustomize.py} $PWD/site > manifest
+        check='import nsp.a, nsp.b; assert (nsp.a.name, nsp.b.name) == ("a", "b")'
+        PYTHONPATH=$PWD/pythonpath NIX_PYTHONPATH=$PWD/site ${python.interpreter} -c "$check"
+        PYTHONPATH=$PWD/pythonpath NIX_PYTHONPATH_MANIFEST=$PWD/manifest ${python.interpreter} -c "$check"
+        touch $out
+      '';
+
+      # The .pth files setuptools writes for namespace packages read the sitedir
+      # local of the frame running them, as site.addpackage provides it
+      nspkg-site-paths = runCommand "${python.name}-nspkg-site-paths" { } ''
+        mkdir -p site/zope/interface
+        echo 'name = "interface"' > site/zope/interface/__init__.py
+        cat > site/zope.interface-nspkg.pth << 'EOF'
+        import sys, types, os;p = os.path.join(sys._getframe(1).f_locals['sitedir'], *('zope',));m = sys.modules.setdefault('zope', types.ModuleType('zope'));mp = m.__dict__.setdefault('__path__',[]);(p not in mp) and mp.append(p)
+        EOF
+        ${python.interpreter} ${./sitecustomize.py} $PWD/site > manifest
+        check='import sys, zope.interface; print(sys.modules["zope"].__path__, zope.interface.name)'
+        NIX_PYTHONPATH=$PWD/site ${python.interpreter} -c "$check" > expected 2>&1
+        NIX_PYTHONPATH_MANIFEST=$PWD/manifest ${python.interpreter} -c "$check" > frozen 2>&1
+        diff -u expected frozen
+        grep -q "^\[.$PWD/site/zope.\] interface$" frozen
+        touch $out
+      '';
+
+      # With indexSitePaths the wrapped program finds its dependencies through
+      # the index, and a namespace package split between PYTHONPATH and a
+      # dependency still imports from both portions.
+      indexed-site-paths =
+        let
+          portion = python.pkgs.buildPythonPackage {
+            pname = "nsp-a";
+            version = "1.0";
+            format = "other";
+            dontUnpack = true;
+            installPhase = ''
+              mkdir -p $out/${python.sitePackages}/nsp
+              echo 'name = "a"' > $out/${python.sitePackages}/nsp/a.py
+            '';
+          };
+          program = python.pkgs.buildPythonPackage {
+            pname = "nsp-check";
+            version = "1.0";
+            format = "other";
+            dontUnpack = true;
+            indexSitePaths = true;
+            propagatedBuildInputs = [ portion ];
+            installPhase = ''
+              mkdir -p $out/bin
+              cat > $out/bin/nsp-check << EOF
+              #!${python.interpreter}
+              import sys, nsp.a, nsp.b
+              assert (nsp.a.name, nsp.b.name) == ("a", "b")
+              assert not [p for p in sys.path if p.startswith("${portion}")], sys.path
+              EOF
+              chmod +x $out/bin/nsp-check
+            '';
+          };
+        in
+        runCommand "${python.name}-indexed-site-paths" { } ''
+          mkdir -p pythonpath/nsp
+          echo 'name = "b"' > pythonpath/nsp/b.py
+          PYTHONPATH=$PWD/pythonpath ${program}/bin/nsp-check
+          touch $out
+        '';
+    }
+  );
+
   # Tests to ensure overriding works as expected.
   overrideTests =
     let
@@ -283,5 +392,5 @@ let
 
 in
 lib.optionalAttrs (stdenv.hostPlatform == stdenv.buildPlatform) (
-  environmentTests // integrationTests // overrideTests // condaTests // editableTests
+  environmentTests // integrationTests // overrideTests // condaTests // editableTests // sitePathsTests
 )
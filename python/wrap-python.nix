@@ -8,11 +8,7 @@
 makePythonHook {
   name = "wrap-python-hook";
   propagatedBuildInputs = [ makeWrapper ];
-  substitutions.sitePackages = python.sitePackages;
-  substitutions.executable = python.interpreter;
-  substitutions.python = python.pythonOnBuildForHost;
-  substitutions.pythonHost = python;
-  substitutions.magicalSedExpression =
+  substitutions =
     let
       # Looks weird? Of course, it's between single quoted shell strings.
       # NOTE: Order DOES matter here, so single character quotes need to be
@@ -45,22 +41,43 @@ makePythonHook {
       # * Sets argv[0] to the original application's name; otherwise it would be .foo-wrapped.
       #   Python doesn't support `exec -a`.
       # * Adds all required libraries to sys.path via `site.addsitedir`. It also handles *.pth files.
+      pythonPath = ''['"$([ -n "$program_PYTHONPATH" ] && (echo "'$program_PYTHONPATH'" | sed "s|:|','|g") || true)"']'';
       preamble = ''
         import sys
         import site
         import functools
         sys.argv[0] = '"'$(readlink -f "$f")'"'
-        functools.reduce(lambda k, p: site.addsitedir(p, k), ['"$([ -n "$program_PYTHONPATH" ] && (echo "'$program_PYTHONPATH'" | sed "s|:|','|g") || true)"'], site._init_pathinfo())
+        functools.reduce(lambda k, p: site.addsitedir(p, k), ${pythonPath}, site._init_pathinfo())
       '';
 
+      # With indexSitePaths, the directories are handed to index_sitedirs from the
+      # interpreter's sitecustomize, so that imports look up top-level modules in an
+      # index of their contents instead of scanning each of them. Other
+      # interpreters fall back to site.addsitedir.
+      indexPreamble = ''
+        import sys
+        import site
+        import functools
+        sys.argv[0] = '"'$(readlink -f "$f")'"'
+        (getattr(sys.modules.get("sitecustomize"), "index_sitedirs", None) or (lambda sitedirs: functools.reduce(lambda k, p: site.addsitedir(p, k), sitedirs, site._init_pathinfo())))(${pythonPath})
+      '';
+
+      mkSedExpression = code: ''
+        1 {
+          :r
+          /\\$|,$/{N;br}
+          /__future__|^ |^ *(#.*)?$/{n;br}
+          ${lib.concatImapStrings mkStringSkipper quoteVariants}
+          /^[^# ]/i ${lib.replaceStrings [ "\n" ] [ ";" ] code}
+        }
+      '';
     in
-    ''
-      1 {
-        :r
-        /\\$|,$/{N;br}
-        /__future__|^ |^ *(#.*)?$/{n;br}
-        ${lib.concatImapStrings mkStringSkipper quoteVariants}
-        /^[^# ]/i ${lib.replaceStrings [ "\n" ] [ ";" ] preamble}
-      }
-    '';
+    {
+      inherit (python) sitePackages;
+      executable = python.interpreter;
+      python = python.pythonOnBuildForHost;
+      pythonHost = python;
+      magicalSedExpression = mkSedExpression preamble;
+      magicalIndexSedExpression = mkSedExpression indexPreamble;
+    };
 } ./wrap.sh
@@ -32,7 +32,11 @@ patchPythonScript() {
     # if you change $f to something else, be sure to also change it
     # in pkgs/top-level/python-packages.nix!
     # It also uses $program_PYTHONPATH.
-    sed -i "$f" -re '@magicalSedExpression@'
+    if [ -n "${indexSitePaths-}" ]; then
+        sed -i "$f" -re '@magicalIndexSedExpression@'
+    else
+        sed -i "$f" -re '@magicalSedExpression@'
+    fi
 }
 
 # Transforms any binaries generated by the setup.py script, replacing them
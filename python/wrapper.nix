@@ -17,6 +17,9 @@
   permitUserSite ? false,
   # Wrap executables with the given argument.
   makeWrapperArgs ? [ ],
+  # Record the sys.path additions and .pth import lines of the environment at
+  # build time, so that wrapped programs do not process .pth files at startup.
+  freezeSitePaths ? false,
 }:
 
 # Create a python executable that knows about additional packages.
@@ -30,6 +33,7 @@ let
       ];
       pythonPath = "${placeholder "out"}/${python.sitePackages}";
       pythonExecutable = "${placeholder "out"}/bin/${python.executable}";
+      sitePathsManifest = "${placeholder "out"}/.nix-python-site-paths";
     in
     buildEnv {
       name = "${python.name}-env";
@@ -40,34 +44,39 @@ let
 
       nativeBuildInputs = [ makeBinaryWrapper ];
 
-      postBuild = ''
-        for path in ${lib.concatStringsSep " " paths}; do
-          if [ -d "$path/bin" ]; then
-            cd "$path/bin"
-            for prg in *; do
-              if [ -f "$prg" ] && [ -x "$prg" ]; then
-                rm -f "$out/bin/$prg"
-                if [ "$prg" = "${python.executable}" ]; then
-                  makeWrapper "${python.interpreter}" "$out/bin/$prg" \
-                    --inherit-argv0 \
-                    ${lib.optionalString (!permitUserSite) ''--set PYTHONNOUSERSITE "true"''} \
-                    ${lib.concatStringsSep " " makeWrapperArgs}
-                elif [ "$(readlink "$prg")" = "${python.executable}" ]; then
-                  ln -s "${python.executable}" "$out/bin/$prg"
-                else
-                  makeWrapper "$path/bin/$prg" "$out/bin/$prg" \
-                    --set NIX_PYTHONPREFIX "$out" \
-                    --set NIX_PYTHONEXECUTABLE ${pythonExecutable} \
-                    --set NIX_PYTHONPATH ${pythonPath} \
-                    ${lib.optionalString (!permitUserSite) ''--set PYTHONNOUSERSITE "true"''} \
-                    ${lib.concatStringsSep " " makeWrapperArgs}
+      postBuild =
+        lib.optionalString freezeSitePaths ''
+          ${python.pythonOnBuildForHost.interpreter} ${./sitecustomize.py} ${pythonPath} > ${sitePathsManifest}
+        ''
+        + ''
+          for path in ${lib.concatStringsSep " " paths}; do
+            if [ -d "$path/bin" ]; then
+              cd "$path/bin"
+              for prg in *; do
+                if [ -f "$prg" ] && [ -x "$prg" ]; then
+                  rm -f "$out/bin/$prg"
+                  if [ "$prg" = "${python.executable}" ]; then
+                    makeWrapper "${python.interpreter}" "$out/bin/$prg" \
+                      --inherit-argv0 \
+                      ${lib.optionalString (!permitUserSite) ''--set PYTHONNOUSERSITE "true"''} \
+                      ${lib.concatStringsSep " " makeWrapperArgs}
+                  elif [ "$(readlink "$prg")" = "${python.executable}" ]; then
+                    ln -s "${python.executable}" "$out/bin/$prg"
+                  else
+                    makeWrapper "$path/bin/$prg" "$out/bin/$prg" \
+                      --set NIX_PYTHONPREFIX "$out" \
+                      --set NIX_PYTHONEXECUTABLE ${pythonExecutable} \
+                      --set NIX_PYTHONPATH ${pythonPath} \
+                      ${lib.optionalString freezeSitePaths "--set NIX_PYTHONPATH_MANIFEST ${sitePathsManifest}"} \
+                      ${lib.optionalString (!permitUserSite) ''--set PYTHONNOUSERSITE "true"''} \
+                      ${lib.concatStringsSep " " makeWrapperArgs}
+                  fi
                 fi
-              fi
-            done
-          fi
-        done
-      ''
-      + postBuild;
+              done
+            fi
+          done
+        ''
+        + postBuild;
 
       inherit (python) meta;
 